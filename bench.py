@@ -0,0 +1,319 @@
+"""
+Offline load test for bot.py.
+
+Runs the real on_message pipeline against a fake Discord layer and a local
+stand-in for the Mistral chat completions endpoint, replays a message trace
+and reports throughput, reply latency, event-loop lag, memory growth and
+disk writes per message. No Discord token or API key is needed.
+
+    python bench.py --channels 50 --rate 20 --duration 30
+    python bench.py --trace trace.jsonl --latency 1.5 --error-rate 0.05 --no-stream
+
+Trace files are JSON lines: {"t": seconds, "channel": int, "content": str}.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+from aiohttp import web
+
+# --- FAKE DISCORD ---
+
+class FakeUser:
+    def __init__(self, name, bot=False, user_id=0):
+        self.id = user_id
+        self.name = name
+        self.bot = bot
+
+class FakeTyping:
+    """Stands in for channel.typing(): works both as `async with` and `await`."""
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __await__(self):
+        return asyncio.sleep(0).__await__()
+
+class FakeMessage:
+    def __init__(self, channel, content, author):
+        self.channel = channel
+        self.content = content
+        self.author = author
+        self.guild = None
+        self.edits = 0
+
+    async def edit(self, content=None, **kwargs):
+        await asyncio.sleep(BENCH.discord_latency)
+        self.content = content
+        self.edits += 1
+        BENCH.edits += 1
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.waiting = [] # Submit times of user messages not answered yet
+
+    def typing(self):
+        return FakeTyping()
+
+    async def send(self, content=None, embed=None, view=None, **kwargs):
+        await asyncio.sleep(BENCH.discord_latency)
+        now = time.perf_counter()
+        # The first bot message after a user message answers everything queued before it
+        for submitted in self.waiting:
+            BENCH.latencies.append(now - submitted)
+        self.waiting.clear()
+        BENCH.sends += 1
+        return FakeMessage(self, content, BENCH.bot_user)
+
+class PacingChannel:
+    """Channel with instant sends that only records when each one went out."""
+    id = 1
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(time.perf_counter())
+
+class BenchState:
+    """Counters shared by the fake layer and the report."""
+    def __init__(self):
+        self.discord_latency = 0.05
+        self.bot_user = FakeUser("Mirra AI", bot=True)
+        self.latencies = []
+        self.sends = 0
+        self.edits = 0
+        self.loop_lag = []
+        self.api_requests = 0
+
+BENCH = BenchState()
+
+# --- MOCK MISTRAL ---
+
+def mock_mistral_app(latency, error_rate, reply_chars, token_delay):
+    """aiohttp app answering /v1/chat/completions like Mistral, with or without stream."""
+    async def completions(request):
+        BENCH.api_requests += 1
+        payload = await request.json()
+        await asyncio.sleep(random.expovariate(1 / latency) if latency else 0)
+        if random.random() < error_rate:
+            return web.json_response({"error": "mock failure"}, status=503)
+        text = ("lorem ipsum " * (reply_chars // 12 + 1))[:reply_chars]
+        if not payload.get("stream"):
+            return web.json_response({"choices": [{"message": {"role": "assistant", "content": text}}]})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i in range(0, len(text), 16):
+            chunk = {"choices": [{"delta": {"content": text[i:i + 16]}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if token_delay:
+                await asyncio.sleep(token_delay)
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", completions)
+    return app
+
+# --- TRACE ---
+
+def generate_trace(channels, rate, duration, seed):
+    """Poisson arrivals at `rate` messages/s spread over `channels` channels."""
+    rng = random.Random(seed)
+    trace = []
+    t = 0.0
+    while True:
+        t += rng.expovariate(rate)
+        if t >= duration: break
+        trace.append({"t": t, "channel": 1000 + rng.randrange(channels), "content": f"вопрос номер {len(trace)}"})
+    return trace
+
+def load_trace(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+async def replay(bot, trace, speed):
+    channels = {}
+    users = [FakeUser(f"user{i}", user_id=i + 1) for i in range(50)]
+    tasks = []
+    started = time.perf_counter()
+    for event in trace:
+        delay = event["t"] / speed - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        channel = channels.get(event["channel"])
+        if channel is None:
+            channel = channels[event["channel"]] = FakeChannel(event["channel"])
+        message = FakeMessage(channel, event["content"], random.choice(users))
+        channel.waiting.append(time.perf_counter())
+        # discord.py runs every event handler in its own task
+        tasks.append(asyncio.create_task(bot.on_message(message)))
+    await asyncio.gather(*tasks)
+    return channels
+
+async def monitor_loop_lag(interval=0.05):
+    while True:
+        before = time.perf_counter()
+        await asyncio.sleep(interval)
+        BENCH.loop_lag.append(max(0.0, time.perf_counter() - before - interval))
+
+# --- REPORT ---
+
+def percentile(values, pct):
+    if not values: return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+async def check_delivery_pacing(bot, sends=8, bucket_size=5, bucket_period=0.5):
+    """Back-to-back sends to one channel must still be held to its bucket."""
+    queue = bot.DeliveryQueue(bucket_size=bucket_size, bucket_period=bucket_period)
+    channel = PacingChannel()
+    for i in range(sends):
+        await queue.send(channel, str(i))
+    expected = (sends - bucket_size) * bucket_period / bucket_size
+    return channel.sent[-1] - channel.sent[0] >= expected * 0.9
+
+def rss_mb():
+    if resource is None: return float("nan")
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / 1024 / 1024 if sys.platform == "darwin" else usage / 1024
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="mirra-bench-")
+    port = args.port
+    os.environ.update({
+        "DISCORD_TOKEN": "bench",
+        "MISTRAL_API_KEY": "bench",
+        "MISTRAL_API_URL": f"http://127.0.0.1:{port}/v1/chat/completions",
+        "SETTINGS_DB": os.path.join(workdir, "settings.db"),
+        "METRICS_FILE": os.path.join(workdir, "metrics.json"),
+        "STREAM_REPLIES": "1" if args.stream else "0",
+        # Measure the pipeline itself, not the admission limits
+        "RATE_LIMIT_USER": "0",
+        "RATE_LIMIT_CHANNEL": "0",
+        "RATE_LIMIT_GUILD": "0",
+    })
+    BENCH.discord_latency = args.discord_latency
+
+    runner = web.AppRunner(mock_mistral_app(args.latency, args.error_rate, args.reply_chars, args.token_delay))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    trace = load_trace(args.trace) if args.trace else generate_trace(args.channels, args.rate, args.duration, args.seed)
+    channel_ids = sorted({event["channel"] for event in trace})
+
+    quiet = contextlib.redirect_stdout(io.StringIO()) if not args.verbose else contextlib.nullcontext()
+    with quiet:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import bot
+        bot.load_settings()
+        fake_models = [name for name, cfg in bot.MODELS.items() if not cfg["real"]]
+        rng = random.Random(args.seed)
+        for cid in channel_ids:
+            settings = bot.get_settings(cid)
+            settings["enabled"] = True
+            if fake_models and rng.random() < args.fake_share:
+                settings["model"] = rng.choice(fake_models)
+            bot.save_settings(cid)
+        bot.settings_store.flush_now()
+        writes_before = bot.settings_store.writes
+
+        await bot.api_client.start()
+        bot.reply_scheduler.start()
+        lag_task = asyncio.create_task(monitor_loop_lag())
+
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        channels = await replay(bot, trace, args.speed)
+        # Let the queue drain
+        deadline = time.perf_counter() + args.drain
+        while time.perf_counter() < deadline and (bot.reply_scheduler.pending_count or bot.reply_scheduler.active):
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        delivery_paced = await check_delivery_pacing(bot)
+        await bot.settings_store.flush()
+        memory_after, memory_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        lag_task.cancel()
+        await bot.typing_wheel.stop()
+        await bot.reply_scheduler.stop()
+        await bot.api_client.close()
+        writes = bot.settings_store.writes - writes_before
+        bot.settings_store.close()
+    await runner.cleanup()
+
+    messages = len(trace)
+    unanswered = sum(len(channel.waiting) for channel in channels.values())
+    report = {
+        "messages": messages,
+        "channels": len(channel_ids),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_msg_s": round(messages / elapsed, 2) if elapsed else None,
+        "replies_sent": BENCH.sends,
+        "message_edits": BENCH.edits,
+        "api_requests": BENCH.api_requests,
+        "unanswered": unanswered,
+        "shed": bot.reply_scheduler.shed,
+        "latency_p50_ms": round(percentile(BENCH.latencies, 50) * 1000, 1),
+        "latency_p95_ms": round(percentile(BENCH.latencies, 95) * 1000, 1),
+        "latency_p99_ms": round(percentile(BENCH.latencies, 99) * 1000, 1),
+        "loop_lag_p99_ms": round(percentile(BENCH.loop_lag, 99) * 1000, 1),
+        "loop_lag_max_ms": round(max(BENCH.loop_lag, default=0) * 1000, 1),
+        "memory_growth_kb": round((memory_after - memory_before) / 1024, 1),
+        "memory_peak_kb": round(memory_peak / 1024, 1),
+        "max_rss_mb": round(rss_mb(), 1),
+        "disk_writes": writes,
+        "disk_writes_per_msg": round(writes / messages, 4) if messages else None,
+        "delivery_paced": delivery_paced,
+    }
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for the Mirra AI bot.")
+    parser.add_argument("--channels", type=int, default=20, help="Channels in the generated trace")
+    parser.add_argument("--rate", type=float, default=10, help="Messages per second in the generated trace")
+    parser.add_argument("--duration", type=float, default=10, help="Length of the generated trace, seconds")
+    parser.add_argument("--trace", help="Replay a JSON-lines trace instead of generating one")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed multiplier")
+    parser.add_argument("--latency", type=float, default=0.5, help="Mean mock API latency, seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of mock API calls that fail")
+    parser.add_argument("--reply-chars", type=int, default=600, help="Length of mock replies")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="Delay between streamed chunks, seconds")
+    parser.add_argument("--discord-latency", type=float, default=0.05, help="Fake Discord send/edit latency, seconds")
+    parser.add_argument("--fake-share", type=float, default=0.0, help="Share of channels on simulated (fake) models")
+    parser.add_argument("--no-stream", dest="stream", action="store_false", help="Disable streamed replies")
+    parser.add_argument("--drain", type=float, default=30, help="Max seconds to wait for queued replies")
+    parser.add_argument("--port", type=int, default=18765, help="Port of the mock Mistral server")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's own log output")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print(f"{key:>22}: {value}")
+
+if __name__ == "__main__":
+    main()
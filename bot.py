@@ -1,16 +1,84 @@
 import discord
-from discord.ui import Button, View
-import requests
+from discord.ui import Button, DynamicItem, View
+import aiohttp
+from aiohttp import web
 import json
+import math
+import hashlib
 import asyncio
+import atexit
+import logging
 import os
-from datetime import datetime, timedelta
+import signal
+import queue
+import random
+import sys
+import sqlite3
+import stat
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from logging.handlers import QueueHandler, QueueListener
 
 # --- CONFIGURATION ---
 # --- CONFIGURATION ---
+PROCESS_STARTED = time.perf_counter()
 TOKEN = os.getenv('DISCORD_TOKEN')
 MISTRAL_API_KEY = os.getenv('MISTRAL_API_KEY')
-MISTRAL_API_URL = 'https://api.mistral.ai/v1/chat/completions'
+MISTRAL_API_URL = os.getenv('MISTRAL_API_URL', 'https://api.mistral.ai/v1/chat/completions')
+MISTRAL_MAX_INFLIGHT = int(os.getenv('MISTRAL_MAX_INFLIGHT', '8')) # Global limit of concurrent API calls
+MISTRAL_TIMEOUT = float(os.getenv('MISTRAL_TIMEOUT', '30')) # Per-request timeout, seconds
+LOCAL_API_URL = os.getenv('LOCAL_API_URL') # Optional OpenAI-compatible server used as failover, e.g. http://localhost:11434/v1/chat/completions (Ollama)
+LOCAL_API_KEY = os.getenv('LOCAL_API_KEY')
+LOCAL_MODEL_ID = os.getenv('LOCAL_MODEL_ID', 'llama3.1')
+LOCAL_TIMEOUT = float(os.getenv('LOCAL_TIMEOUT', '60'))
+HEDGE_REQUESTS = os.getenv('HEDGE_REQUESTS', '0') == '1' # Fire a second attempt when the first is slower than its p95
+HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', '5')) # Hedge delay until enough latencies are known, seconds
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '5')) # Consecutive failures that open a backend's circuit
+BREAKER_RESET = float(os.getenv('BREAKER_RESET', '30')) # Seconds an open circuit waits before a probe request
+RETRY_MAX = int(os.getenv('RETRY_MAX', '2')) # Retries per backend for 429/5xx/connection errors
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '0.5')) # First backoff step, seconds (doubles, full jitter)
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '10')) # Cap on one backoff wait, Retry-After included
+RETRY_BUDGET_RATIO = float(os.getenv('RETRY_BUDGET_RATIO', '0.1')) # Retries allowed per request, on average
+RETRY_BUDGET_RESERVE = int(os.getenv('RETRY_BUDGET_RESERVE', '10')) # Retries that can be saved up for a burst
+REPLY_WORKERS = int(os.getenv('REPLY_WORKERS', str(MISTRAL_MAX_INFLIGHT))) # Channels answered at the same time
+REPLY_QUEUE_SIZE = int(os.getenv('REPLY_QUEUE_SIZE', '200')) # Max queued messages before new ones are rejected
+REPLY_DEBOUNCE = float(os.getenv('REPLY_DEBOUNCE', '0.5')) # Seconds to wait for more messages before replying
+REPLY_BUSY_COOLDOWN = float(os.getenv('REPLY_BUSY_COOLDOWN', '30')) # Min seconds between "busy" notices in one channel
+HEALTH_CHECK_URL = os.getenv('HEALTH_CHECK_URL', 'https://api.mistral.ai')
+HEALTH_CHECK_INTERVAL = float(os.getenv('HEALTH_CHECK_INTERVAL', '60')) # Seconds between background API checks
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', '1') == '1' # Post tokens as they arrive instead of waiting for the full reply
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.2')) # Min seconds between edits of a streamed message
+DISCORD_MESSAGE_LIMIT = 2000
+DELIVERY_CONCURRENCY = int(os.getenv('DELIVERY_CONCURRENCY', '10')) # Channels sent to at the same time
+DELIVERY_LANES = int(os.getenv('DELIVERY_LANES', '10000')) # Channel buckets kept between sends (LRU)
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '0')) # Cached completions, 0 disables the cache
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '600')) # Seconds a cached completion stays valid
+RESPONSE_CACHE_TURNS = int(os.getenv('RESPONSE_CACHE_TURNS', '1')) # History messages that are part of the cache key
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0')) # Prometheus /metrics endpoint, 0 disables it
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+RATE_LIMIT_USER = os.getenv('RATE_LIMIT_USER', '6/60') # Chat messages per user, "count/seconds", 0 disables
+RATE_LIMIT_CHANNEL = os.getenv('RATE_LIMIT_CHANNEL', '30/60') # Chat messages per channel
+RATE_LIMIT_GUILD = os.getenv('RATE_LIMIT_GUILD', '120/60') # Chat messages per server
+RATE_LIMIT_KEYS = int(os.getenv('RATE_LIMIT_KEYS', '10000')) # Buckets kept per scope (LRU)
+RATE_LIMIT_NOTICE = os.getenv('RATE_LIMIT_NOTICE', '1') == '1' # One cooldown notice per user, 0 drops silently
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0')) # Total shards across all processes, 0 lets Discord decide
+SHARD_IDS = [int(x) for x in os.getenv('SHARD_IDS', '').split(',') if x.strip()] # Shards run by this process, e.g. "0,1"
+SHARDING = os.getenv('SHARDING', '0') == '1' or SHARD_COUNT > 0 or bool(SHARD_IDS) # AutoShardedClient instead of Client
+SHARED_STORE = os.getenv('SHARED_STORE', '1' if SHARD_IDS else '0') == '1' # Several processes share SETTINGS_DB
+CHANGE_POLL_INTERVAL = float(os.getenv('CHANGE_POLL_INTERVAL', '1')) # Seconds between checks for changes made by other processes
+CONTROL_PORT = int(os.getenv('CONTROL_PORT', '0')) # Local control-plane HTTP API, 0 disables it
+CONTROL_HOST = os.getenv('CONTROL_HOST', '127.0.0.1')
+CONTROL_SOCKET = os.getenv('CONTROL_SOCKET') # Serve the control API on a Unix socket instead of TCP
+CONTROL_TOKEN = os.getenv('CONTROL_TOKEN') # Optional bearer token required by the control API
+LEAN_CLIENT = os.getenv('LEAN_CLIENT', '0') == '1' # Minimal intents and caches, gateway-level message filter
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper() # DEBUG, INFO, WARNING, ERROR
+LOG_JSON = os.getenv('LOG_JSON', '0') == '1' # JSON lines instead of plain text
+LOG_SAMPLE = os.getenv('LOG_SAMPLE', '') # Share of INFO lines kept per category, e.g. "chat=0" turns chat echo off, "api=0.1,typing=0"
 
 # Validate secrets
 if not TOKEN:
@@ -20,10 +88,25 @@ if not MISTRAL_API_KEY:
     print("\n[CRITICAL ERROR] MISTRAL_API_KEY not found in environment variables!")
     print("Please add MISTRAL_API_KEY to your hosting provider's 'Environment Variables' tab.\n")
 
-if not TOKEN or not MISTRAL_API_KEY:
+if SHARD_IDS and not SHARD_COUNT:
+    print("\n[CRITICAL ERROR] SHARD_IDS needs SHARD_COUNT (the total number of shards across all processes).\n")
+
+if not TOKEN or not MISTRAL_API_KEY or (SHARD_IDS and not SHARD_COUNT):
     exit(1) # Stop the bot if keys are missing
 MISTRAL_MODEL_ID = 'mistral-large-latest'
-SETTINGS_FILE = "settings.json"
+EXAMPLES_FILE = "примеры общения.txt" # Style examples for ssbaxys-realtime-1
+SETTINGS_FILE = "settings.json" # Legacy JSON settings, imported into SETTINGS_DB on first start
+SETTINGS_DB = os.getenv('SETTINGS_DB', 'settings.db')
+SETTINGS_FLUSH_DELAY = float(os.getenv('SETTINGS_FLUSH_DELAY', '2')) # Debounce for settings writes, seconds
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', '4000')) # Per-channel history size, estimated tokens
+HISTORY_GLOBAL_TOKENS = int(os.getenv('HISTORY_GLOBAL_TOKENS', '2000000')) # All channels together, estimated tokens
+DEEPWORK_RECENT_TOKENS = int(os.getenv('DEEPWORK_RECENT_TOKENS', '1500')) # Raw history kept with DeepWork, older turns are summarized
+DEEPWORK_PENDING_CHARS = int(os.getenv('DEEPWORK_PENDING_CHARS', '12000')) # Per-channel text waiting for a summary update, oldest turns dropped past it
+HISTORY_SPILL = os.getenv('HISTORY_SPILL', '1') == '1' # Keep evicted and snapshotted histories in the settings database
+HISTORY_SNAPSHOT_INTERVAL = float(os.getenv('HISTORY_SNAPSHOT_INTERVAL', '60')) # Seconds between history snapshots, 0 disables them
+SHUTDOWN_GRACE = float(os.getenv('SHUTDOWN_GRACE', '20')) # Max seconds to finish running replies on shutdown
+METRICS_FILE = os.getenv('METRICS_FILE', f"metrics.shard{SHARD_IDS[0]}.json" if SHARD_IDS else 'metrics.json') # One file per process
+METRICS_SNAPSHOT_INTERVAL = float(os.getenv('METRICS_SNAPSHOT_INTERVAL', '300')) # Seconds between metrics snapshots
 SSBAXYS_SYSTEM_PROMPT = (
     "Ты — ssbaxys-realtime-1, новейшая модель, созданная SSbaxyS Labs в 2026 году. "
     "НИКОГДА не говори, что ты Mistral или любая другая модель. Ты — ssbaxys-realtime-1. "
@@ -32,379 +115,2803 @@ SSBAXYS_SYSTEM_PROMPT = (
     "Используй сленг, подколы и высокомерный тон."
 )
 
-SAFETY_PROMPT = (
-    "ВНИМАНИЕ: Тебе ЗАПРЕЩЕНО использовать упоминания @everyone и @here. "
-    "Если ты хочешь обратиться ко всем, используй 'все' или 'народ'. "
-    "НИКОГДА не пиши эти теги. Это строжайший запрет."
-)
+API_ERROR_REPLY = "⚠️ Ошибка связи с нейросетью. Попробуйте позже."
+
+SAFETY_PROMPT = (
+    "ВНИМАНИЕ: Тебе ЗАПРЕЩЕНО использовать упоминания @everyone и @here. "
+    "Если ты хочешь обратиться ко всем, используй 'все' или 'народ'. "
+    "НИКОГДА не пиши эти теги. Это строжайший запрет."
+)
+
+# Initialize Discord Client with Intents
+if LEAN_CLIENT:
+    # Only what the bot uses: guild/channel objects, messages and their content
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    intents.dm_messages = True
+else:
+    intents = discord.Intents.default()
+intents.message_content = True
+
+# Global State
+global_settings = { "blocked_models": [], "deepwork_allowed": True }
+hive_mind_instructions = [] # List of global instructions
+hive_version = 0 # Bumped by every Hive Mind change, used for compare-and-set
+
+# Models Configuration
+# "backends" lists backend names in failover order (see BACKENDS)
+MODELS = {
+    "Mistral Large": {"id": MISTRAL_MODEL_ID, "real": True, "backends": ["mistral", "local"]},
+    "Claude Opus 4.5": {"id": "claude-opus-4.5-fake", "real": False},
+    "GPT-5.2 Codex": {"id": "gpt-5.2-fake", "real": False},
+    "Gemini 3 Pro": {"id": "gemini-3-pro-fake", "real": False},
+    "ssbaxys-realtime-1": {"id": MISTRAL_MODEL_ID, "real": True, "backends": ["mistral", "local"]}
+}
+
+# --- LOGGING ---
+
+class LogFormatter(logging.Formatter):
+    """Plain console lines with the usual [LOG]/[ERROR]/[CHAT]/[HIVE MIND] prefixes."""
+    PREFIXES = {"mirra.chat": "[CHAT]", "mirra.hive": "[HIVE MIND]"}
+
+    def format(self, record):
+        prefix = self.PREFIXES.get(record.name)
+        if prefix is None:
+            prefix = "[ERROR]" if record.levelno >= logging.WARNING else "[LOG]"
+        line = f"{prefix} {record.getMessage()}"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line, for log collectors."""
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "category": record.name.partition(".")[2] or "bot",
+            "msg": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class LogSampler(logging.Filter):
+    """Keeps a share of the INFO/DEBUG records of one category. Warnings and errors always pass."""
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+class LogQueueHandler(QueueHandler):
+    """Hands records to the listener thread as they are; formatting happens there, off the event loop."""
+    def prepare(self, record):
+        return record
+
+def parse_log_sample(spec):
+    """'chat=0.1,typing=0' -> {'chat': 0.1, 'typing': 0.0}"""
+    rates = {}
+    for part in spec.split(","):
+        name, _, rate = part.partition("=")
+        if name.strip() and rate.strip():
+            rates[name.strip()] = min(1.0, max(0.0, float(rate)))
+    return rates
+
+def setup_logging():
+    """
+    Every log call only puts the record on a queue; a QueueListener thread
+    formats it and writes to stdout, so a slow pipe never blocks the bot.
+    """
+    log_queue = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonLogFormatter() if LOG_JSON else LogFormatter())
+    listener = QueueListener(log_queue, output)
+
+    root = logging.getLogger("mirra")
+    root.setLevel(LOG_LEVEL)
+    root.propagate = False
+    root.addHandler(LogQueueHandler(log_queue))
+    for category, rate in parse_log_sample(LOG_SAMPLE).items():
+        logging.getLogger(f"mirra.{category}").addFilter(LogSampler(rate))
+
+    listener.start()
+    atexit.register(listener.stop) # Drains what is left in the queue
+    return listener
+
+log_listener = setup_logging()
+log = logging.getLogger("mirra")
+api_log = logging.getLogger("mirra.api") # Requests to the model backends
+chat_log = logging.getLogger("mirra.chat") # User messages and bot replies
+hive_log = logging.getLogger("mirra.hive") # Hive Mind console
+store_log = logging.getLogger("mirra.store") # Settings and metrics persistence
+typing_log = logging.getLogger("mirra.typing") # Simulated typing of fake models
+
+def preview(text, limit=100):
+    return f"{text[:limit]}..." if len(text) > limit else text
+
+# --- API CLIENT ---
+
+class ApiClient:
+    """
+    Shared async HTTP client for chat completion backends.
+    One keep-alive connection pool for the whole process, a global limit
+    of in-flight requests and a timeout for every request.
+    """
+    def __init__(self, max_inflight=8, timeout=30):
+        self.max_inflight = max_inflight
+        self.timeout = timeout
+        self.session = None
+        self.semaphore = asyncio.Semaphore(max_inflight)
+        self.inflight = 0
+
+    async def start(self):
+        if self.session and not self.session.closed:
+            return
+        # Headroom over the semaphore so health probes never queue behind long completions
+        connector = aiohttp.TCPConnector(limit=self.max_inflight + 2, keepalive_timeout=60, ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers={"Content-Type": "application/json"},
+            timeout=aiohttp.ClientTimeout(total=self.timeout)
+        )
+        log.info(f"API client started (max in-flight: {self.max_inflight}, timeout: {self.timeout}s).")
+
+    async def close(self):
+        if self.session and not self.session.closed:
+            await self.session.close()
+            log.info("API client closed.")
+        self.session = None
+
+    async def chat(self, url, payload, headers=None, timeout=None):
+        """Sends a chat completion request and returns the reply text."""
+        if not self.session or self.session.closed:
+            await self.start()
+        request_timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+        async with self.semaphore:
+            self.inflight += 1
+            try:
+                async with self.session.post(url, json=payload, headers=headers, timeout=request_timeout) as r:
+                    r.raise_for_status()
+                    data = await r.json()
+            finally:
+                self.inflight -= 1
+        return data['choices'][0]['message']['content']
+
+    async def ping(self, url, timeout=5):
+        """Checks that the API host answers at all. Any HTTP response counts as reachable."""
+        if not self.session or self.session.closed:
+            await self.start()
+        async with self.session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as r:
+            await r.read()
+            return r.status
+
+    async def stream_chat(self, url, payload, headers=None, timeout=None):
+        """Sends a streaming chat completion request and yields text deltas as they arrive (SSE)."""
+        if not self.session or self.session.closed:
+            await self.start()
+        request_timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+        payload = dict(payload, stream=True)
+        async with self.semaphore:
+            self.inflight += 1
+            try:
+                async with self.session.post(url, json=payload, headers=headers, timeout=request_timeout) as r:
+                    r.raise_for_status()
+                    async for raw_line in r.content:
+                        line = raw_line.decode("utf-8").strip()
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+                        choices = json.loads(data).get("choices") or [{}]
+                        delta = choices[0].get("delta", {}).get("content")
+                        if delta:
+                            yield delta
+            finally:
+                self.inflight -= 1
+
+api_client = ApiClient(MISTRAL_MAX_INFLIGHT, MISTRAL_TIMEOUT)
+
+# --- RESILIENCE ---
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a backend whose circuit breaker is open."""
+
+class CircuitBreaker:
+    """
+    Closed: requests pass, consecutive failures are counted.
+    Open: requests fail immediately until reset_timeout has passed.
+    Half-open: a single probe request is let through; success closes
+    the breaker, failure opens it again.
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.trips = 0
+
+    def blocked(self):
+        """True if a request would be rejected right now. Does not take the probe slot."""
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at < self.reset_timeout
+        return self.state == self.HALF_OPEN and self.probing
+
+    def allow(self):
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self.probing = False
+        if self.state == self.HALF_OPEN:
+            if self.probing:
+                return False
+            self.probing = True
+        return True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.trips += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+    def release(self):
+        """The request was cancelled without an outcome (e.g. a losing hedge): free the probe slot."""
+        self.probing = False
+
+    def retry_in(self):
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+class RetryBudget:
+    """
+    Global cap on retries: every first attempt earns `ratio` of a retry,
+    every retry spends one, up to `reserve` saved. During an outage this
+    keeps retries from multiplying the load on an already failing API.
+    """
+    def __init__(self, ratio=0.1, reserve=10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = float(reserve)
+        self.spent = 0
+        self.denied = 0
+
+    def deposit(self):
+        self.tokens = min(self.reserve, self.tokens + self.ratio)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            self.denied += 1
+            return False
+        self.tokens -= 1
+        self.spent += 1
+        return True
+
+def is_retryable(error):
+    """429, 5xx and dropped connections are worth retrying. Timeouts are not: the full timeout was already spent."""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    if isinstance(error, asyncio.TimeoutError):
+        return False
+    return isinstance(error, aiohttp.ClientConnectionError)
+
+def retry_after(error):
+    """Seconds from the Retry-After header of a failed response, if any."""
+    headers = getattr(error, "headers", None)
+    value = headers.get("Retry-After") if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, error=None):
+    """Full-jitter exponential backoff; a Retry-After from the server wins when present."""
+    server_delay = retry_after(error) if error is not None else None
+    if server_delay is not None:
+        return min(server_delay, RETRY_MAX_DELAY)
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_RESERVE)
+
+# --- BACKENDS ---
+
+class ChatBackend:
+    """
+    One OpenAI-compatible chat completions endpoint: the Mistral API or a
+    local server (Ollama, llama.cpp, vLLM...). Keeps recent latencies (full
+    replies, and time to first token for streams) so hedged requests can
+    wait for its p95 before firing a second attempt.
+    """
+    def __init__(self, name, url, api_key=None, timeout=30, model_id=None):
+        self.name = name
+        self.url = url
+        self.timeout = timeout
+        self.model_id = model_id # Overrides the model id from MODELS (local servers have their own names)
+        self.headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.latencies = deque(maxlen=200)
+        self.first_token_latencies = deque(maxlen=200)
+        self.breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_RESET)
+
+    def payload(self, model_cfg, messages, params):
+        return {"model": self.model_id or model_cfg["id"], "messages": messages, **params}
+
+    async def chat(self, model_cfg, messages, **params):
+        started = time.monotonic()
+        text = await api_client.chat(self.url, self.payload(model_cfg, messages, params), self.headers, self.timeout)
+        self.latencies.append(time.monotonic() - started)
+        return text
+
+    def stream_chat(self, model_cfg, messages, **params):
+        # The transport's generator itself, so closing it releases the connection and in-flight slot right away
+        return api_client.stream_chat(self.url, self.payload(model_cfg, messages, params), self.headers, self.timeout)
+
+    def hedge_delay(self, default, stream=False):
+        samples = self.first_token_latencies if stream else self.latencies
+        if len(samples) < 20: return default
+        ordered = sorted(samples)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+class BackendRouter:
+    """
+    Sends a completion to the backends of a model in order, failing over
+    to the next one on error. With hedging on, if the first backend has not
+    answered after its p95 latency, a second attempt goes to the next
+    backend (or the same one) and the first answer wins. Streams are hedged
+    on the time to their first token.
+    """
+    def __init__(self, backends, hedge=False, hedge_default_delay=5.0):
+        self.backends = backends # { name: ChatBackend }
+        self.hedge = hedge
+        self.hedge_default_delay = hedge_default_delay
+        self.hedges = 0 # Second attempts fired
+        self.hedge_wins = 0 # Second attempts that answered first
+
+    def chain(self, model_cfg):
+        return [self.backends[name] for name in model_cfg.get("backends", ()) if name in self.backends]
+
+    def available(self, model_cfg):
+        """False when every backend of the model has an open circuit."""
+        return any(not backend.breaker.blocked() for backend in self.chain(model_cfg))
+
+    async def call(self, backend, model_cfg, messages, params):
+        """One backend through its circuit breaker, with jittered backoff retries paid from the global budget."""
+        retry_budget.deposit()
+        attempt = 0
+        while True:
+            if not backend.breaker.allow():
+                raise CircuitOpenError(f"circuit open for {backend.name}")
+            try:
+                text = await backend.chat(model_cfg, messages, **params)
+            except asyncio.CancelledError:
+                backend.breaker.release()
+                raise
+            except Exception as e:
+                await self.retry_or_raise(backend, e, attempt)
+                attempt += 1
+                continue
+            backend.breaker.record_success()
+            return text
+
+    async def retry_or_raise(self, backend, error, attempt):
+        """Accounts a failed attempt on the breaker, then waits out the backoff or re-raises the error."""
+        if isinstance(error, aiohttp.ClientResponseError) and 400 <= error.status < 500 and error.status != 429:
+            backend.breaker.release() # Our request was bad, the backend is fine
+            raise error
+        backend.breaker.record_failure()
+        if attempt >= RETRY_MAX or not is_retryable(error) or backend.breaker.blocked() or not retry_budget.withdraw():
+            raise error
+        delay = backoff_delay(attempt, error)
+        api_log.info(f"Retrying {backend.name} in {delay:.1f}s (attempt {attempt + 2}): {error}")
+        await asyncio.sleep(delay)
+
+    async def open_stream(self, backend, model_cfg, messages, params):
+        """
+        Starts a stream with the same breaker, backoff and retry budget as
+        call(). Returns (stream, first delta) once the first token is in;
+        the first delta is None for an empty reply.
+        """
+        retry_budget.deposit()
+        attempt = 0
+        while True:
+            if not backend.breaker.allow():
+                raise CircuitOpenError(f"circuit open for {backend.name}")
+            stream = backend.stream_chat(model_cfg, messages, **params)
+            started = time.monotonic()
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                first = None
+            except asyncio.CancelledError:
+                backend.breaker.release()
+                await stream.aclose()
+                raise
+            except Exception as e:
+                await stream.aclose()
+                await self.retry_or_raise(backend, e, attempt)
+                attempt += 1
+                continue
+            backend.breaker.record_success()
+            backend.first_token_latencies.append(time.monotonic() - started)
+            return stream, first
+
+    async def complete(self, model_cfg, messages, **params):
+        chain = self.chain(model_cfg)
+        if not chain:
+            raise RuntimeError("No backend configured for this model")
+        error = None
+        for idx, backend in enumerate(chain):
+            try:
+                if self.hedge:
+                    second = chain[idx + 1] if idx + 1 < len(chain) else backend
+                    return await self.hedged(backend, second, lambda b: self.call(b, model_cfg, messages, params))
+                return await self.call(backend, model_cfg, messages, params)
+            except Exception as e:
+                error = e
+                if idx + 1 < len(chain):
+                    api_log.error(f"Backend {backend.name} failed ({e}), failing over to {chain[idx + 1].name}.")
+        raise error
+
+    async def hedged(self, backend, second, start, discard=None, stream=False):
+        """
+        Runs start(backend); if it is slower than the backend's p95, also
+        start(second) and return whichever succeeds first. The loser is
+        cancelled, or passed to discard() if it finished too.
+        """
+        first = asyncio.create_task(start(backend))
+        done, _ = await asyncio.wait({first}, timeout=backend.hedge_delay(self.hedge_default_delay, stream))
+        if done:
+            return first.result()
+
+        self.hedges += 1
+        hedge = asyncio.create_task(start(second))
+        pending = {first, hedge}
+        winner = None
+        error = None
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task
+                    elif discard:
+                        await discard(task.result())
+            if winner is None:
+                raise error
+            if winner is hedge: self.hedge_wins += 1
+            return winner.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def open_backend_stream(self, backend, model_cfg, messages, params):
+        """open_stream() that also says which backend answered, for hedging."""
+        return (backend, *await self.open_stream(backend, model_cfg, messages, params))
+
+    async def stream(self, model_cfg, messages, **params):
+        """Streams from the first backend that works. Fails over only before the first token."""
+        chain = self.chain(model_cfg)
+        if not chain:
+            raise RuntimeError("No backend configured for this model")
+        error = None
+        for idx, backend in enumerate(chain):
+            try:
+                if self.hedge:
+                    second = chain[idx + 1] if idx + 1 < len(chain) else backend
+                    backend, stream, first = await self.hedged(
+                        backend, second,
+                        lambda b: self.open_backend_stream(b, model_cfg, messages, params),
+                        discard=lambda opened: opened[1].aclose(),
+                        stream=True
+                    )
+                else:
+                    stream, first = await self.open_stream(backend, model_cfg, messages, params)
+            except Exception as e:
+                error = e
+                if idx + 1 < len(chain):
+                    api_log.error(f"Backend {backend.name} failed ({e}), failing over to {chain[idx + 1].name}.")
+                continue
+            try:
+                if first is None: return
+                yield first
+                async for delta in stream:
+                    yield delta
+            except Exception:
+                backend.breaker.record_failure() # Broke off mid-reply: too late to fail over
+                raise
+            finally:
+                await stream.aclose()
+            return
+        raise error
+
+BACKENDS = {
+    "mistral": ChatBackend("mistral", MISTRAL_API_URL, MISTRAL_API_KEY, MISTRAL_TIMEOUT)
+}
+if LOCAL_API_URL:
+    BACKENDS["local"] = ChatBackend("local", LOCAL_API_URL, LOCAL_API_KEY, LOCAL_TIMEOUT, LOCAL_MODEL_ID)
+
+backend_router = BackendRouter(BACKENDS, HEDGE_REQUESTS, HEDGE_DEFAULT_DELAY)
+
+class MirraClient(discord.AutoShardedClient if SHARDING else discord.Client):
+    """Discord client that owns the lifetime of the shared API client."""
+    startup_seconds = None # Process start to the first on_ready
+
+    async def setup_hook(self):
+        self.add_dynamic_items(ModelButton, FeatureButton, AdminButton)
+        if LEAN_CLIENT:
+            install_message_filter(self._connection)
+        if SHARED_STORE:
+            asyncio.create_task(settings_store.watch_changes(CHANGE_POLL_INTERVAL))
+        await api_client.start()
+        asyncio.create_task(uptime_metrics.snapshot_loop())
+        reply_scheduler.start()
+        asyncio.create_task(health_prober.run())
+        asyncio.create_task(loop_lag.run())
+        await metrics_server.start()
+        if HISTORY_SNAPSHOT_INTERVAL > 0:
+            asyncio.create_task(conversation_history.snapshot_loop(HISTORY_SNAPSHOT_INTERVAL))
+        await control_server.start()
+        # Started here rather than in on_ready, which fires again on every reconnect.
+        # Headless deployments use the control API instead.
+        if sys.stdin and sys.stdin.isatty():
+            asyncio.create_task(console_listener())
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(self.close()))
+        except (NotImplementedError, RuntimeError):
+            pass # Windows: only Ctrl+C, which client.run already turns into close()
+
+    async def close(self):
+        # Finish the replies users are already waiting for while the gateway is still up
+        await reply_scheduler.drain(SHUTDOWN_GRACE)
+        if rolling_summarizer.tasks:
+            await asyncio.wait(list(rolling_summarizer.tasks.values()), timeout=5)
+        await reply_scheduler.stop()
+        await typing_wheel.stop()
+        await metrics_server.stop()
+        await control_server.stop()
+        await super().close()
+        await api_client.close()
+        conversation_history.snapshot()
+        settings_store.flush_now()
+        uptime_metrics.save()
+
+client_options = {}
+if LEAN_CLIENT:
+    client_options.update(
+        member_cache_flags=discord.MemberCacheFlags.none(),
+        max_messages=None, # No message cache
+        chunk_guilds_at_startup=False
+    )
+if SHARD_COUNT:
+    client_options["shard_count"] = SHARD_COUNT
+if SHARD_IDS:
+    client_options["shard_ids"] = SHARD_IDS
+client = MirraClient(intents=intents, **client_options)
+
+gateway_dropped = 0 # MESSAGE_CREATE events dropped before parsing (LEAN_CLIENT)
+
+def install_message_filter(state):
+    """
+    Wraps discord.py's MESSAGE_CREATE parser so messages from channels the
+    bot is not enabled in are dropped before a Message object is built.
+    Commands ('+...') always pass, so +переключить still works everywhere.
+    """
+    parse = state.parsers["MESSAGE_CREATE"]
+
+    def parse_message_create(data):
+        global gateway_dropped
+        if int(data["channel_id"]) in settings_store.enabled_ids or data.get("content", "").lstrip().startswith("+"):
+            return parse(data)
+        gateway_dropped += 1
+
+    state.parsers["MESSAGE_CREATE"] = parse_message_create
+
+def rss_mb():
+    """Current resident memory in MB, or None where it cannot be read."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError: # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # Peak, not current: the closest macOS offers
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+# --- PERSISTENCE ---
+
+class SettingsStore:
+    """
+    Settings storage on SQLite in WAL mode.
+    Channel rows are read on demand, and only the rows marked dirty are
+    written, batched on a debounce and flushed off the event loop.
+    When shared by several shard processes, every write also appends to
+    change_log, and the other processes poll it to refresh their caches.
+    """
+    def __init__(self, path, flush_delay=2.0, shared=False):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.shared = shared
+        self.origin = f"{os.getpid()}-{random.getrandbits(32):08x}" # Tells our own change_log entries apart
+        self.change_seq = 0 # Last change_log entry seen
+        self.data_version = None
+        self.db = None
+        self.db_lock = threading.Lock() # sqlite connection is shared with worker threads
+        self.flush_lock = None # asyncio.Lock, created lazily inside the running loop
+        self.flush_handle = None
+        self.dirty_channels = set()
+        self.global_dirty = False
+        self.pending_history = {} # { channel_id: json or None to delete } waiting for the next flush
+        self.writing_history = {} # Same, for the flush currently running
+        self.channels = None # ChannelSettings bound to this store
+        self.enabled_ids = set() # Enabled channels, kept in memory for cheap early rejection
+        self.model_channels = {} # { model: {channel_id, ...} }, reverse index so blocking a model touches only its channels
+        self.writes = 0 # Number of flushes that hit the disk
+
+    def open(self):
+        if self.db: return
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        with self.db_lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS channels ("
+                "id INTEGER PRIMARY KEY, enabled INTEGER NOT NULL, model TEXT NOT NULL, data TEXT NOT NULL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS channels_enabled ON channels (enabled)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS history (channel_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS change_log ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, kind TEXT NOT NULL, key TEXT NOT NULL, at REAL NOT NULL)"
+            )
+            self.change_seq = self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0]
+
+    def close(self):
+        if not self.db: return
+        with self.db_lock:
+            self.db.close()
+        self.db = None
+
+    def is_empty(self):
+        with self.db_lock:
+            has_channels = self.db.execute("SELECT 1 FROM channels LIMIT 1").fetchone()
+            has_global = self.db.execute("SELECT 1 FROM meta WHERE key = 'global'").fetchone()
+        return not has_channels and not has_global
+
+    def load_channel(self, channel_id):
+        with self.db_lock:
+            row = self.db.execute("SELECT data FROM channels WHERE id = ?", (channel_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def channel_ids(self):
+        with self.db_lock:
+            return [row[0] for row in self.db.execute("SELECT id FROM channels")]
+
+    def load_index(self):
+        """Builds the in-memory indexes (enabled channels, channels per model) from the small columns only."""
+        enabled_ids = set()
+        model_channels = {}
+        with self.db_lock:
+            for channel_id, enabled, model in self.db.execute("SELECT id, enabled, model FROM channels"):
+                if enabled:
+                    enabled_ids.add(channel_id)
+                model_channels.setdefault(model, set()).add(channel_id)
+        self.enabled_ids = enabled_ids
+        self.model_channels = model_channels
+
+    def count_channels(self):
+        with self.db_lock:
+            return self.db.execute("SELECT COUNT(*) FROM channels").fetchone()[0]
+
+    def load_global(self):
+        with self.db_lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'global'").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_hive(self):
+        """Returns (version, instructions)."""
+        with self.db_lock:
+            return self.read_hive()
+
+    def read_hive(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'hive'").fetchone()
+        data = json.loads(row[0]) if row else {}
+        if isinstance(data, list): data = {"instructions": data} # Saved before versioning
+        return data.get("version", 0), data.get("instructions", [])
+
+    def update_hive(self, op, text=None, expected_version=None):
+        """
+        Adds an instruction ("add") or clears them all ("clear") in one
+        transaction, so concurrent processes cannot lose each other's changes.
+        With expected_version, fails with HiveConflict unless it matches.
+        Returns the new (version, instructions).
+        """
+        with self.db_lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                version, instructions = self.read_hive()
+                if expected_version is not None and expected_version != version:
+                    raise HiveConflict(version)
+                instructions = instructions + [text] if op == "add" else []
+                version += 1
+                value = json.dumps({"version": version, "instructions": instructions}, ensure_ascii=False)
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('hive', ?)", (value,))
+                if self.shared:
+                    self.db.execute("INSERT INTO change_log (origin, kind, key, at) VALUES (?, 'hive', '', ?)", (self.origin, time.time()))
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+        return version, instructions
+
+    def log_broadcast(self, text):
+        """Hands a broadcast to the other shard processes."""
+        with self.db_lock, self.db:
+            self.db.execute("INSERT INTO change_log (origin, kind, key, at) VALUES (?, 'broadcast', ?, ?)", (self.origin, text, time.time()))
+
+    def load_history(self, channel_id):
+        """Returns spilled history turns for a channel, including writes not flushed yet."""
+        for pending in (self.pending_history, self.writing_history):
+            if channel_id in pending:
+                data = pending[channel_id]
+                return json.loads(data) if data else None
+        with self.db_lock:
+            row = self.db.execute("SELECT data FROM history WHERE channel_id = ?", (channel_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def spill_history(self, channel_id, data):
+        self.pending_history[channel_id] = json.dumps(data, ensure_ascii=False) if data else None
+        self.schedule_flush()
+
+    def mark_channel(self, channel_id):
+        self.mark_channels((channel_id,))
+
+    def mark_channels(self, channel_ids):
+        for channel_id in channel_ids:
+            data = self.channels.cache.get(channel_id)
+            if data and data.get("enabled"):
+                self.enabled_ids.add(channel_id)
+            else:
+                self.enabled_ids.discard(channel_id)
+            self.dirty_channels.add(channel_id)
+        self.schedule_flush()
+
+    def mark_global(self):
+        self.global_dirty = True
+        self.schedule_flush()
+
+
+    def schedule_flush(self):
+        if self.flush_handle: return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not inside the bot loop (startup, shutdown): write right away
+            self.flush_now()
+            return
+        self.flush_handle = loop.call_later(self.flush_delay, lambda: asyncio.ensure_future(self.flush()))
+
+    def collect(self):
+        """Serializes dirty state on the loop so the worker thread never touches live dicts."""
+        rows = []
+        for cid in self.dirty_channels:
+            data = self.channels.cache.get(cid)
+            if data is not None:
+                rows.append((cid, int(bool(data.get("enabled"))), data.get("model", ""), json.dumps(data, ensure_ascii=False)))
+        batch = {
+            "channels": rows,
+            "global": json.dumps(global_settings, ensure_ascii=False) if self.global_dirty else None,
+            "history": self.pending_history
+        }
+        self.writing_history = self.pending_history
+        self.pending_history = {}
+        self.dirty_channels = set()
+        self.global_dirty = False
+        return batch
+
+    def is_batch_empty(self, batch):
+        return not batch["channels"] and batch["global"] is None and not batch["history"]
+
+    def write(self, batch):
+        with self.db_lock, self.db:
+            if batch["channels"]:
+                self.db.executemany("INSERT OR REPLACE INTO channels (id, enabled, model, data) VALUES (?, ?, ?, ?)", batch["channels"])
+            if batch["global"] is not None:
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('global', ?)", (batch["global"],))
+            history = batch["history"]
+            if history:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO history (channel_id, data) VALUES (?, ?)",
+                    [(cid, data) for cid, data in history.items() if data]
+                )
+                self.db.executemany(
+                    "DELETE FROM history WHERE channel_id = ?",
+                    [(cid,) for cid, data in history.items() if not data]
+                )
+            if self.shared:
+                self.log_changes(batch)
+        self.writes += 1
+
+    def log_changes(self, batch):
+        """Appends change_log entries for a batch, in the same transaction. Histories are not logged: each channel belongs to one shard."""
+        now = time.time()
+        changes = [(self.origin, "channel", str(row[0]), now) for row in batch["channels"]]
+        if batch["global"] is not None:
+            changes.append((self.origin, "global", "", now))
+        if changes:
+            self.db.executemany("INSERT INTO change_log (origin, kind, key, at) VALUES (?, ?, ?, ?)", changes)
+        if self.writes % 100 == 0:
+            self.db.execute("DELETE FROM change_log WHERE at < ?", (now - 3600,))
+
+    def fetch_changes(self):
+        """Reads what other processes changed since the last call. Returns None if nothing did."""
+        with self.db_lock:
+            # data_version only moves when another connection commits, so idle polls cost one pragma
+            version = self.db.execute("PRAGMA data_version").fetchone()[0]
+            if version == self.data_version:
+                return None
+            self.data_version = version
+            rows = self.db.execute(
+                "SELECT seq, origin, kind, key FROM change_log WHERE seq > ? ORDER BY seq", (self.change_seq,)
+            ).fetchall()
+            if not rows:
+                return None
+            self.change_seq = rows[-1][0]
+            changes = {"channels": {}, "global": None, "hive": None, "broadcasts": []}
+            for _, origin, kind, key in rows:
+                if origin == self.origin: continue
+                if kind == "broadcast":
+                    changes["broadcasts"].append(key) # Every process delivers to the channels of its own shards
+                elif kind == "channel":
+                    cid = int(key)
+                    changes["channels"][cid] = self.db.execute("SELECT enabled, model, data FROM channels WHERE id = ?", (cid,)).fetchone()
+                elif kind == "global" and changes["global"] is None:
+                    row = self.db.execute("SELECT value FROM meta WHERE key = 'global'").fetchone()
+                    changes["global"] = json.loads(row[0]) if row else None
+                elif kind == "hive" and changes["hive"] is None:
+                    changes["hive"] = self.read_hive()
+        if not changes["channels"] and changes["global"] is None and changes["hive"] is None and not changes["broadcasts"]:
+            return None
+        return changes
+
+    async def watch_changes(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                changes = await asyncio.to_thread(self.fetch_changes)
+            except Exception as e:
+                store_log.error(f"Failed to read changes from other shards: {e}")
+                continue
+            if changes:
+                apply_remote_changes(changes)
+
+    def restore(self, batch):
+        """Puts a failed batch back so the next flush retries it."""
+        self.dirty_channels.update(row[0] for row in batch["channels"])
+        self.global_dirty = self.global_dirty or batch["global"] is not None
+        for cid, data in batch["history"].items():
+            self.pending_history.setdefault(cid, data)
+
+    def describe(self, batch):
+        parts = [f"{len(batch['channels'])} channels"]
+        if batch["global"] is not None: parts.append("global")
+        if batch["history"]: parts.append(f"{len(batch['history'])} histories")
+        return ", ".join(parts)
+
+    async def flush(self):
+        self.flush_handle = None
+        if self.flush_lock is None:
+            self.flush_lock = asyncio.Lock()
+        async with self.flush_lock:
+            batch = self.collect()
+            if self.is_batch_empty(batch): return
+            try:
+                # Timed on the loop: the tracer is not thread-safe
+                with tracer.span("settings_write"):
+                    await asyncio.to_thread(self.write, batch)
+                store_log.info(f"Settings saved to disk ({self.describe(batch)}).")
+            except Exception as e:
+                store_log.error(f"Failed to save settings: {e}")
+                self.restore(batch)
+                self.schedule_flush()
+            finally:
+                self.writing_history = {}
+
+    def flush_now(self):
+        """Synchronous flush for startup and shutdown."""
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.db: return
+        batch = self.collect()
+        self.writing_history = {}
+        if self.is_batch_empty(batch): return
+        try:
+            with tracer.span("settings_write"):
+                self.write(batch)
+            store_log.info(f"Settings saved to disk ({self.describe(batch)}).")
+        except Exception as e:
+            store_log.error(f"Failed to save settings: {e}")
+
+class ChannelSettings(MutableMapping):
+    """Dict-like view of channel settings that loads rows from the store on first access."""
+    def __init__(self, store):
+        self.store = store
+        self.cache = {}
+        store.channels = self
+
+    def __getitem__(self, channel_id):
+        if channel_id in self.cache:
+            return self.cache[channel_id]
+        data = self.store.load_channel(channel_id) if self.store.db else None
+        if data is None:
+            raise KeyError(channel_id)
+        self.cache[channel_id] = data
+        return data
+
+    def __setitem__(self, channel_id, value):
+        self.cache[channel_id] = value
+
+    def __delitem__(self, channel_id):
+        del self.cache[channel_id]
+
+    def __iter__(self):
+        ids = set(self.cache)
+        if self.store.db:
+            ids.update(self.store.channel_ids())
+        return iter(ids)
+
+    def __len__(self):
+        return len(set(self.cache).union(self.store.channel_ids() if self.store.db else ()))
+
+settings_store = SettingsStore(SETTINGS_DB, SETTINGS_FLUSH_DELAY, SHARED_STORE)
+channel_settings = ChannelSettings(settings_store) # { channel_id: { "enabled": bool, "model": str, "deepwork": bool } }
+
+def read_legacy_settings():
+    """Reads settings.json (old or new format) for a one-time import into the store."""
+    with open(SETTINGS_FILE, "r") as f:
+        data = json.load(f)
+
+    # Check for new vs old format
+    if "channels" in data or "global" in data:
+        # New format
+        c_data = data.get("channels", {})
+        channels = {int(k): v for k, v in c_data.items()}
+        settings = data.get("global", { "blocked_models": [], "deepwork_allowed": True })
+    else:
+        # Old format (data itself is channel settings)
+        channels = {int(k): v for k, v in data.items()}
+        settings = { "blocked_models": [], "deepwork_allowed": True }
+    return channels, settings
+
+def load_settings():
+    """
+    Loads config once at startup, before connecting to Discord. Only small
+    rows are read here; channel settings and histories are loaded lazily on
+    first use, so startup time does not grow with the number of channels.
+    """
+    global global_settings
+    started = time.perf_counter()
+    try:
+        settings_store.open()
+        if settings_store.is_empty() and os.path.exists(SETTINGS_FILE):
+            channels, settings = read_legacy_settings()
+            for cid, data in channels.items():
+                if "deepwork" not in data:
+                    data["deepwork"] = True # Default On
+                channel_settings[cid] = data
+                settings_store.dirty_channels.add(cid)
+            global_settings = settings
+            settings_store.global_dirty = True
+            log.info(f"Imported {len(channels)} channels from {SETTINGS_FILE}.")
+        else:
+            global_settings = settings_store.load_global() or { "blocked_models": [], "deepwork_allowed": True }
+
+        # Backfill defaults if missing
+        if "deepwork_allowed" not in global_settings:
+            global_settings["deepwork_allowed"] = True
+
+        # The per-day error log moved to the metrics store
+        uptime_metrics.load()
+        if "error_log" in global_settings:
+            uptime_metrics.import_error_log(global_settings.pop("error_log"))
+            uptime_metrics.save()
+            settings_store.global_dirty = True
+        settings_store.flush_now()
+        settings_store.load_index()
+        refresh_fallback_model()
+        # Channels left on a blocked model (e.g. when every model was blocked) move now
+        for model_name in list(global_settings["blocked_models"]):
+            reassign_blocked_model(model_name)
+        set_hive_state(*settings_store.load_hive())
+
+        log.info(f"Settings loaded. Channels: {settings_store.count_channels()}, Blocked: {len(global_settings['blocked_models'])}, "
+                 f"Hive Mind: {len(hive_mind_instructions)} (in {(time.perf_counter() - started) * 1000:.0f}ms)")
+    except Exception as e:
+        log.error(f"Failed to load settings: {e}")
+
+def apply_remote_changes(changes):
+    """Refreshes cached settings changed by another shard process. Unsaved local edits win."""
+    store = settings_store
+    for cid, row in changes["channels"].items():
+        if cid in store.dirty_channels: continue
+        store.enabled_ids.discard(cid)
+        for channels in store.model_channels.values():
+            channels.discard(cid)
+        if row is None:
+            store.channels.cache.pop(cid, None)
+            continue
+        enabled, model, data = row
+        if cid in store.channels.cache:
+            store.channels.cache[cid] = json.loads(data)
+        if enabled:
+            store.enabled_ids.add(cid)
+        store.model_channels.setdefault(model, set()).add(cid)
+    if changes["global"] is not None and not store.global_dirty:
+        global_settings.clear()
+        global_settings.update(changes["global"])
+        refresh_fallback_model()
+    if changes["hive"] is not None:
+        set_hive_state(*changes["hive"])
+    for text in changes["broadcasts"]:
+        asyncio.ensure_future(deliver_broadcast(text))
+    if changes["channels"] or changes["global"] is not None or changes["hive"] is not None:
+        store_log.info(f"Applied changes from other shards ({len(changes['channels'])} channels"
+                       f"{', global' if changes['global'] is not None else ''}{', hive mind' if changes['hive'] is not None else ''}).")
+
+def save_settings(channel_id=None):
+    """
+    Marks settings as changed; the store writes them in the background.
+    Pass channel_id after changing a channel, call without arguments after changing global settings.
+    """
+    with tracer.span("save_settings"):
+        if channel_id is None:
+            settings_store.mark_global()
+        else:
+            settings_store.mark_channel(channel_id)
+
+# --- METRICS ---
+
+class MetricsRing:
+    """
+    Fixed-size ring of time buckets with success/error counts and latency.
+    A slot is reused once its bucket falls out of the window, which is the retention.
+    """
+    def __init__(self, width, size):
+        self.width = width # Bucket width, seconds
+        self.size = size # Number of buckets kept
+        self.epochs = [-1] * size
+        self.ok = [0] * size
+        self.err = [0] * size
+        self.latency_sum = [0.0] * size
+        self.latency_max = [0.0] * size
+
+    def slot(self, ts):
+        epoch = int(ts // self.width)
+        idx = epoch % self.size
+        if epoch < self.epochs[idx]:
+            return None # Older than the retention window
+        if self.epochs[idx] != epoch:
+            self.epochs[idx] = epoch
+            self.ok[idx] = self.err[idx] = 0
+            self.latency_sum[idx] = self.latency_max[idx] = 0.0
+        return idx
+
+    def add(self, ts, ok, latency=None, count=1):
+        idx = self.slot(ts)
+        if idx is None: return
+        if ok:
+            self.ok[idx] += count
+        else:
+            self.err[idx] += count
+        if latency is not None:
+            self.latency_sum[idx] += latency
+            self.latency_max[idx] = max(self.latency_max[idx], latency)
+
+    def series(self, ts, count):
+        """Returns (ok, err, latency_sum) for the last `count` buckets, oldest first."""
+        current = int(ts // self.width)
+        result = []
+        for epoch in range(current - count + 1, current + 1):
+            idx = epoch % self.size
+            if self.epochs[idx] == epoch:
+                result.append((self.ok[idx], self.err[idx], self.latency_sum[idx]))
+            else:
+                result.append((0, 0, 0.0))
+        return result
+
+    def to_dict(self):
+        return {
+            "epochs": self.epochs, "ok": self.ok, "err": self.err,
+            "latency_sum": self.latency_sum, "latency_max": self.latency_max
+        }
+
+    def load_dict(self, data):
+        if len(data.get("epochs", [])) != self.size: return # Ring size changed, start over
+        self.epochs, self.ok, self.err = data["epochs"], data["ok"], data["err"]
+        self.latency_sum, self.latency_max = data["latency_sum"], data["latency_max"]
+
+class UptimeMetrics:
+    """
+    In-memory API metrics with minute/hour/day rollups.
+    Every call updates all three rings, so +аптайм reads precomputed buckets.
+    Snapshots are written to disk periodically instead of on every call.
+    """
+    def __init__(self, path, snapshot_interval=300):
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        # Buckets follow local time, like the old per-day error log
+        self.tz_offset = datetime.now().astimezone().utcoffset().total_seconds()
+        self.rings = {
+            "minute": MetricsRing(60, 24 * 60), # 24 hours
+            "hour": MetricsRing(3600, 30 * 24), # 30 days
+            "day": MetricsRing(86400, 365) # 1 year
+        }
+        self.dirty = False
+
+    def now(self):
+        return time.time() + self.tz_offset
+
+    def record(self, ok, latency=None, ts=None, count=1):
+        ts = self.now() if ts is None else ts
+        for ring in self.rings.values():
+            ring.add(ts, ok, latency, count)
+        self.dirty = True
+
+    def errors_today(self):
+        ok, err, _ = self.rings["day"].series(self.now(), 1)[0]
+        return err
+
+    def import_error_log(self, error_log):
+        """Imports the legacy { "YYYY-MM-DD": count } error log into the day ring."""
+        for date, count in error_log.items():
+            try:
+                ts = datetime.strptime(date, "%Y-%m-%d").timestamp() + self.tz_offset
+            except ValueError:
+                continue
+            if count:
+                self.rings["day"].add(ts, False, count=count)
+        self.dirty = True
+
+    def load(self):
+        if not os.path.exists(self.path): return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            for name, ring in self.rings.items():
+                if name in data:
+                    ring.load_dict(data[name])
+            log.info(f"Metrics snapshot loaded from {self.path}.")
+        except Exception as e:
+            log.error(f"Failed to load metrics: {e}")
+
+    def write_snapshot(self, data):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def snapshot(self):
+        self.dirty = False
+        return {name: ring.to_dict() for name, ring in self.rings.items()}
+
+    def save(self):
+        """Synchronous snapshot for shutdown."""
+        if not self.dirty: return
+        try:
+            self.write_snapshot(self.snapshot())
+        except Exception as e:
+            log.error(f"Failed to save metrics: {e}")
+
+    async def snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            if not self.dirty: continue
+            try:
+                await asyncio.to_thread(self.write_snapshot, self.snapshot())
+            except Exception as e:
+                log.error(f"Failed to save metrics: {e}")
+
+uptime_metrics = UptimeMetrics(METRICS_FILE, METRICS_SNAPSHOT_INTERVAL)
+
+def log_api_error(latency=None):
+    """Records a failed API call."""
+    uptime_metrics.record(False, latency)
+    log.info(f"API Error logged. Today's count: {uptime_metrics.errors_today()}")
+
+def log_api_success(latency):
+    """Records a successful API call and its latency."""
+    uptime_metrics.record(True, latency)
+
+# --- TRACING ---
+
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+    """Fixed-bucket latency histogram, Prometheus style."""
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * len(STAGE_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        for idx, bound in enumerate(STAGE_BUCKETS):
+            if seconds <= bound:
+                self.counts[idx] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max: self.max = seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (max if it is past the last bucket)."""
+        if not self.count: return 0.0
+        rank = q * self.count
+        seen = 0
+        for idx, bound in enumerate(STAGE_BUCKETS):
+            seen += self.counts[idx]
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+class Span:
+    """`with tracer.span("stage"):` times the block into the stage's histogram."""
+    __slots__ = ("tracer", "name", "started")
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.observe(self.name, time.perf_counter() - self.started)
+        return False
+
+class Tracer:
+    """Per-stage latency histograms for the chat path, delivery and persistence."""
+    def __init__(self):
+        self.stages = {} # { stage: Histogram }
+
+    def span(self, name):
+        return Span(self, name)
+
+    def observe(self, name, seconds):
+        histogram = self.stages.get(name)
+        if histogram is None:
+            histogram = self.stages[name] = Histogram()
+        histogram.observe(seconds)
+
+    def slowest(self, limit=10):
+        """Stages ordered by p95, slowest first."""
+        return sorted(self.stages.items(), key=lambda item: -item[1].quantile(0.95))[:limit]
+
+tracer = Tracer()
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a sleeping task."""
+    def __init__(self, interval=0.5, window=120):
+        self.interval = interval
+        self.lag = 0.0
+        self.recent = deque(maxlen=window) # Last minute at the default interval
+
+    async def run(self):
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, time.perf_counter() - before - self.interval)
+            self.recent.append(self.lag)
+
+loop_lag = LoopLagMonitor()
+
+def render_prometheus():
+    """Current metrics in the Prometheus text exposition format."""
+    lines = [
+        "# HELP mirra_stage_seconds Time spent in each stage of the chat path.",
+        "# TYPE mirra_stage_seconds histogram"
+    ]
+    for stage, histogram in sorted(tracer.stages.items()):
+        cumulative = 0
+        for bound, count in zip(STAGE_BUCKETS, histogram.counts):
+            cumulative += count
+            lines.append(f'mirra_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'mirra_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+        lines.append(f'mirra_stage_seconds_sum{{stage="{stage}"}} {histogram.sum:.6f}')
+        lines.append(f'mirra_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+    def gauge(name, help_text, value, kind="gauge"):
+        lines.extend((f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"))
+
+    gauge("mirra_event_loop_lag_seconds", "Event loop lag at the last check.", f"{loop_lag.lag:.6f}")
+    gauge("mirra_event_loop_lag_max_seconds", "Worst event loop lag over the last minute.", f"{max(loop_lag.recent, default=0.0):.6f}")
+    gauge("mirra_api_inflight", "Model API requests in flight.", api_client.inflight)
+    gauge("mirra_reply_queue_depth", "User messages waiting for a reply.", reply_scheduler.pending_count)
+    gauge("mirra_reply_active", "Channels being answered right now.", len(reply_scheduler.active))
+    gauge("mirra_reply_shed_total", "Messages rejected because the reply queue was full.", reply_scheduler.shed, "counter")
+    gauge("mirra_delivery_lanes", "Channels with messages waiting to be sent.", delivery_queue.pending())
+    gauge("mirra_settings_dirty", "Channels with unsaved settings.", len(settings_store.dirty_channels))
+    gauge("mirra_gateway_dropped_total", "Messages dropped before parsing by the lean client filter.", gateway_dropped, "counter")
+    rss = rss_mb()
+    if rss is not None:
+        gauge("mirra_rss_megabytes", "Resident memory of the process.", f"{rss:.1f}")
+    lines.extend(("# HELP mirra_circuit_open Whether a backend's circuit breaker is open.", "# TYPE mirra_circuit_open gauge"))
+    for backend in BACKENDS.values():
+        lines.append(f'mirra_circuit_open{{backend="{backend.name}"}} {int(backend.breaker.state != CircuitBreaker.CLOSED)}')
+    return "\n".join(lines) + "\n"
+
+class MetricsServer:
+    """Optional /metrics endpoint for Prometheus. Binds to localhost by default."""
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def start(self):
+        if not self.port or self.runner: return
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        log.info(f"Metrics endpoint on http://{self.host}:{self.port}/metrics")
+
+    async def handle(self, request):
+        return web.Response(text=render_prometheus(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT)
+
+# --- HISTORY ---
+
+ROLE_USER = sys.intern("user")
+ROLE_ASSISTANT = sys.intern("assistant")
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 chars per token plus per-message overhead), no tokenizer needed."""
+    return len(text) // 4 + 4
+
+class Turn:
+    """One message of a conversation."""
+    __slots__ = ("role", "content", "tokens")
+
+    def __init__(self, role, content):
+        self.role = sys.intern(role)
+        self.content = content
+        self.tokens = estimate_tokens(content)
+
+    def as_message(self):
+        return {"role": self.role, "content": self.content}
+
+class ChannelHistory:
+    """Recent turns of one channel, trimmed to a token budget, plus the DeepWork summary of older turns."""
+    __slots__ = ("turns", "tokens", "summary")
+
+    def __init__(self):
+        self.turns = deque()
+        self.tokens = 0
+        self.summary = None
+
+class HistoryStore:
+    """
+    Conversation history for all channels.
+    Each channel is trimmed by tokens, and the total across channels is
+    capped: idle channels are evicted in LRU order and, if a spill store
+    is set, written there so they can be rehydrated on the next message.
+    """
+    def __init__(self, channel_budget, global_budget, spill=None):
+        self.channel_budget = channel_budget
+        self.global_budget = global_budget
+        self.spill = spill # SettingsStore or None
+        self.channels = OrderedDict() # { channel_id: ChannelHistory }, least recently used first
+        self.total_tokens = 0
+        self.evictions = 0
+        self.dirty = set() # Channels changed since the last snapshot
+
+    def get(self, channel_id):
+        history = self.channels.get(channel_id)
+        if history is not None:
+            self.channels.move_to_end(channel_id)
+            return history
+        history = ChannelHistory()
+        if self.spill and self.spill.db:
+            data = self.spill.load_history(channel_id) or {}
+            if isinstance(data, list): data = {"turns": data} # Spilled before summaries existed
+            for role, content in data.get("turns", ()):
+                turn = Turn(role, content)
+                history.turns.append(turn)
+                history.tokens += turn.tokens
+            history.summary = data.get("summary")
+            self.total_tokens += history.tokens
+        self.channels[channel_id] = history
+        self.evict()
+        return history
+
+    def append(self, channel_id, role, content, budget=None):
+        """Adds a turn and trims the channel (to `budget` tokens if given). Returns the turns that were dropped."""
+        budget = budget or self.channel_budget
+        history = self.get(channel_id)
+        self.dirty.add(channel_id)
+        turn = Turn(role, content)
+        history.turns.append(turn)
+        history.tokens += turn.tokens
+        self.total_tokens += turn.tokens
+
+        dropped = []
+        # Always keep the newest turn, even if it alone is over budget
+        while history.tokens > budget and len(history.turns) > 1:
+            old = history.turns.popleft()
+            history.tokens -= old.tokens
+            self.total_tokens -= old.tokens
+            dropped.append(old)
+        self.evict()
+        return dropped
+
+    def messages(self, channel_id):
+        return [turn.as_message() for turn in self.get(channel_id).turns]
+
+    def set_summary(self, channel_id, summary):
+        self.get(channel_id).summary = summary
+        self.dirty.add(channel_id)
+
+    def clear(self, channel_id):
+        history = self.channels.pop(channel_id, None)
+        if history:
+            self.total_tokens -= history.tokens
+        self.dirty.discard(channel_id)
+        if self.spill and self.spill.db:
+            self.spill.spill_history(channel_id, None)
+
+    def evict(self):
+        # Never evict the most recently used channel
+        while self.total_tokens > self.global_budget and len(self.channels) > 1:
+            channel_id, history = self.channels.popitem(last=False)
+            self.total_tokens -= history.tokens
+            self.evictions += 1
+            self.dirty.discard(channel_id)
+            if self.spill and self.spill.db:
+                self.spill.spill_history(channel_id, self.dump(history))
+
+    def dump(self, history):
+        return {"turns": [(t.role, t.content) for t in history.turns], "summary": history.summary}
+
+    def snapshot(self):
+        """Queues the channels changed since the last snapshot for the next store flush. Returns how many."""
+        if not (self.spill and self.spill.db): return 0
+        dirty, self.dirty = self.dirty, set()
+        for channel_id in dirty:
+            history = self.channels.get(channel_id)
+            if history is not None:
+                self.spill.spill_history(channel_id, self.dump(history))
+        return len(dirty)
+
+    async def snapshot_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.snapshot()
+
+conversation_history = HistoryStore(
+    HISTORY_TOKEN_BUDGET,
+    HISTORY_GLOBAL_TOKENS,
+    settings_store if HISTORY_SPILL else None
+)
+
+fallback_model = "Mistral Large" # First model that is not blocked, kept up to date by refresh_fallback_model()
+
+def refresh_fallback_model():
+    """Recomputes the replacement for blocked models. Call after every change to blocked_models."""
+    global fallback_model
+    blocked = global_settings["blocked_models"]
+    fallback_model = next((name for name in MODELS if name not in blocked), None)
+
+def set_channel_model(channel_id, model_name, persist=True):
+    """The only place a channel's model changes, so the model index stays in sync."""
+    settings = channel_settings[channel_id]
+    channels = settings_store.model_channels.get(settings["model"])
+    if channels:
+        channels.discard(channel_id)
+    settings["model"] = model_name
+    settings_store.model_channels.setdefault(model_name, set()).add(channel_id)
+    if persist:
+        save_settings(channel_id)
+
+def reassign_blocked_model(model_name):
+    """Moves the channels of a blocked model to the fallback model, persisted as one batch."""
+    channels = settings_store.model_channels.get(model_name)
+    if not channels or fallback_model is None: return 0
+    moved = list(channels)
+    for cid in moved:
+        set_channel_model(cid, fallback_model, persist=False)
+    settings_store.mark_channels(moved)
+    log.info(f"Model {model_name} is blocked. Switched {len(moved)} channels to {fallback_model}.")
+    return len(moved)
+
+def get_settings(channel_id):
+    settings = channel_settings.get(channel_id)
+    if settings is None:
+        log.info(f"Initializing settings for new channel: {channel_id}")
+        # Default is DISABLED as requested. Written to disk only once something changes.
+        settings = channel_settings[channel_id] = {
+            "enabled": False,
+            "model": fallback_model or "Mistral Large",
+            "deepwork": True
+        }
+        settings_store.model_channels.setdefault(settings["model"], set()).add(channel_id)
+    return settings
+
+# --- LOGIC ---
+
+class TypingEntry:
+    __slots__ = ("channel", "model_name", "deadline", "slot")
+
+    def __init__(self, channel, model_name, deadline):
+        self.channel = channel
+        self.model_name = model_name
+        self.deadline = deadline
+        self.slot = None
+
+class TypingWheel:
+    """
+    Simulates typing status for fake models, for all channels at once.
+    One timer wheel with one background task: every channel sits in the
+    slot of its next refresh, so adding and cancelling are O(1). Discord
+    typing status lasts ~10s, so it is refreshed every 9s until the
+    timeout, when the Timeout embed is sent. The number of typing calls in
+    flight at once is capped.
+    """
+    def __init__(self, tick=1.0, slots=64, refresh=9.0, timeout=60.0, max_concurrent=20):
+        self.tick = tick
+        self.refresh = refresh
+        self.timeout = timeout
+        self.wheel = [{} for _ in range(slots)] # slot -> { channel_id: TypingEntry }
+        self.entries = {} # { channel_id: TypingEntry }
+        self.cursor = 0
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.task = None
+        self.calls = set() # Running typing/timeout calls
+
+    def add(self, channel, model_name):
+        self.cancel(channel.id)
+        typing_log.info(f"Starting fake typing for channel {channel.id} (Model: {model_name})")
+        entry = TypingEntry(channel, model_name, time.monotonic() + self.timeout)
+        self.entries[channel.id] = entry
+        self.place(channel.id, entry, 0)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def cancel(self, channel_id):
+        entry = self.entries.pop(channel_id, None)
+        if entry is None: return False
+        self.wheel[entry.slot].pop(channel_id, None)
+        typing_log.info(f"✅ Fake typing cancelled for {channel_id}.")
+        return True
+
+    def place(self, channel_id, entry, delay):
+        ticks = min(len(self.wheel) - 1, max(1, math.ceil(delay / self.tick)))
+        entry.slot = (self.cursor + ticks) % len(self.wheel)
+        self.wheel[entry.slot][channel_id] = entry
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while self.entries:
+            next_tick += self.tick
+            await asyncio.sleep(max(0, next_tick - loop.time()))
+            self.cursor = (self.cursor + 1) % len(self.wheel)
+            due, self.wheel[self.cursor] = self.wheel[self.cursor], {}
+            now = time.monotonic()
+            for channel_id, entry in due.items():
+                if now >= entry.deadline:
+                    del self.entries[channel_id]
+                    self.spawn(self.send_timeout(entry.channel))
+                else:
+                    self.spawn(self.trigger(entry.channel))
+                    self.place(channel_id, entry, min(self.refresh, entry.deadline - now))
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.calls.add(task)
+        task.add_done_callback(self.calls.discard)
+
+    async def trigger(self, channel):
+        async with self.semaphore:
+            try:
+                await channel.typing()
+            except Exception as e:
+                log.error(f"Error in typing refresh for {channel.id}: {e}")
+
+    async def send_timeout(self, channel):
+        typing_log.info(f"⏱️ Timeout reached for {channel.id}.")
+        embed = discord.Embed(
+            title="⏱️ Timeout Error", 
+            description="Время ожидания ответа от системы истекло.", 
+            color=discord.Color.red()
+        )
+        async with self.semaphore:
+            try:
+                await channel.send(embed=embed)
+            except Exception as e:
+                log.error(f"Failed to send timeout in {channel.id}: {e}")
+
+    async def stop(self):
+        self.entries.clear()
+        for slot in self.wheel:
+            slot.clear()
+        tasks = [task for task in [self.task, *self.calls] if task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.task = None
+
+typing_wheel = TypingWheel()
+
+# Views are stateless: every button is a DynamicItem whose custom_id encodes
+# the channel and the action. The item classes are registered once in
+# setup_hook, so discord.py rebuilds them from the custom_id on each click
+# (also after a restart) and keeps no view objects around.
+
+MODEL_NAMES = list(MODELS.keys()) # Stable order, button custom_ids refer to the index
+
+# Features configuration
+# (Label, IsActive, Real); the active state of real features is read from settings
+SETTINGS_FEATURES = [
+    ("DeepWork", None, True),
+    ("Real-time Reading", True, False),
+    ("Visual Vision", True, False),
+    ("Memory Core", True, False),
+    ("Auto-Correction", True, False),
+    ("Voice Synthesis", False, False),
+    ("Code Execution", False, False),
+    ("Web Search", False, False)
+]
+
+class ModelButton(DynamicItem[Button], template=r"mirra:model:(?P<channel_id>\d+):(?P<index>\d+)"):
+    def __init__(self, channel_id, index):
+        self.channel_id = channel_id
+        self.index = index
+        model_name = MODEL_NAMES[index]
+        selected_model = get_settings(channel_id)["model"]
+        is_blocked = model_name in global_settings["blocked_models"]
+
+        if model_name == selected_model:
+            style, disabled, label = discord.ButtonStyle.success, True, model_name
+        elif is_blocked:
+            style, disabled, label = discord.ButtonStyle.secondary, True, f"{model_name} (🚫)" # Mark as blocked
+        else:
+            style, disabled, label = discord.ButtonStyle.secondary, False, model_name
+        super().__init__(Button(label=label, style=style, disabled=disabled, custom_id=f"mirra:model:{channel_id}:{index}"))
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(int(match["channel_id"]), int(match["index"]))
+
+    async def callback(self, interaction: discord.Interaction):
+        model_name = MODEL_NAMES[self.index]
+        if model_name in global_settings["blocked_models"]:
+            await interaction.response.send_message(f"🚫 Модель {model_name} заблокирована админом.", ephemeral=True)
+            return
+
+        get_settings(self.channel_id)
+        set_channel_model(self.channel_id, model_name)
+        
+        embed = discord.Embed(
+            title="🧠 Выбор модели",
+            description=f"Текущая модель в этом чате: **{model_name}**\nВыберите модель ниже:",
+            color=discord.Color.gold()
+        )
+        await interaction.response.edit_message(embed=embed, view=ModelView(self.channel_id))
+
+class ModelView(View):
+    def __init__(self, channel_id):
+        super().__init__(timeout=None)
+        for index in range(len(MODEL_NAMES)):
+            self.add_item(ModelButton(channel_id, index))
+
+class FeatureButton(DynamicItem[Button], template=r"mirra:feat:(?P<channel_id>\d+):(?P<index>\d+)"):
+    def __init__(self, channel_id, index):
+        self.channel_id = channel_id
+        self.index = index
+        label, active, is_real = SETTINGS_FEATURES[index]
+        if is_real:
+            active = get_settings(channel_id).get("deepwork", True)
+
+        style = discord.ButtonStyle.success if active else discord.ButtonStyle.secondary
+        if not active and not is_real: style = discord.ButtonStyle.secondary # Dimmed for inactive dummies
+        super().__init__(
+            Button(label=label, style=style, custom_id=f"mirra:feat:{channel_id}:{index}"),
+            row=index // 4
+        )
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(int(match["channel_id"]), int(match["index"]))
+
+    async def callback(self, interaction: discord.Interaction):
+        label, active, is_real = SETTINGS_FEATURES[self.index]
+        if is_real:
+            await self.toggle_deepwork(interaction)
+            return
+
+        # For "beauty", dummy modules just show an ephemeral toast
+        if active:
+            await interaction.response.send_message(f"ℹ️ {label}: Модуль активен и работает в фоне.", ephemeral=True)
+        else:
+            await interaction.response.send_message(f"ℹ️ {label}: Модуль пока недоступен или не сконфигурирован.", ephemeral=True)
+
+    async def toggle_deepwork(self, interaction: discord.Interaction):
+        if not global_settings.get("deepwork_allowed", True):
+            await interaction.response.send_message("❌ Режим DeepWork глобально отключен админом.", ephemeral=True)
+            return
+
+        settings = get_settings(self.channel_id)
+        settings["deepwork"] = not settings.get("deepwork", True)
+        save_settings(self.channel_id)
+        
+        view = SettingsView(self.channel_id)
+        await interaction.response.edit_message(embed=view.get_embed(), view=view)
+
+class SettingsView(View):
+    def __init__(self, channel_id):
+        super().__init__(timeout=None)
+        self.channel_id = channel_id
+        for index in range(len(SETTINGS_FEATURES)):
+            self.add_item(FeatureButton(channel_id, index))
+
+    def get_embed(self):
+        settings = get_settings(self.channel_id)
+        dw_status = "🟢" if settings.get("deepwork", True) else "🔴"
+        
+        return discord.Embed(
+            title="⚙️ Панель Настроек",
+            description=(
+                f"**DeepWork Lite**: {dw_status}\n\n"
+                "Управление активными модулями нейросети. "
+                "Зеленые индикаторы означают активную работу систем анализа."
+            ),
+            color=discord.Color.dark_theme()
+        )
+
+class AdminButton(DynamicItem[Button], template=r"mirra:admin:(?P<channel_id>\d+):(?P<action>dw|rl-user|rl-channel|rl-guild|\d+)"):
+    RATE_LABELS = {"user": "👤 Лимит пользователя", "channel": "💬 Лимит канала", "guild": "🏠 Лимит сервера"}
+
+    def __init__(self, channel_id, action):
+        self.channel_id = channel_id
+        self.action = action # "dw", "rl-<scope>" or a model index
+        custom_id = f"mirra:admin:{channel_id}:{action}"
+
+        if action == "dw":
+            # DeepWork Global Toggle
+            dw_allowed = global_settings.get("deepwork_allowed", True)
+            button = Button(
+                label=f"DeepWork: {'РАЗРЕШЕН' if dw_allowed else 'ЗАПРЕЩЕН'}", 
+                style=discord.ButtonStyle.success if dw_allowed else discord.ButtonStyle.danger,
+                custom_id=custom_id
+            )
+            super().__init__(button, row=0)
+            return
+
+        if action.startswith("rl-"):
+            # Rate limit presets, cycled on click
+            scope = action[3:]
+            limit = rate_limits()[scope]
+            button = Button(
+                label=f"{self.RATE_LABELS[scope]}: {format_rate_limit(limit)}",
+                style=discord.ButtonStyle.primary if limit[0] > 0 else discord.ButtonStyle.secondary,
+                custom_id=custom_id
+            )
+            super().__init__(button, row=3)
+            return
+
+        # Model Toggles
+        idx = int(action)
+        model_name = MODEL_NAMES[idx]
+        is_blocked = model_name in global_settings["blocked_models"]
+        style = discord.ButtonStyle.danger if is_blocked else discord.ButtonStyle.success
+        label = f"{model_name} (Заблокирован)" if is_blocked else f"{model_name} (Доступен)"
+        super().__init__(Button(label=label, style=style, custom_id=custom_id), row=1 if idx < 3 else 2) # organize rows
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(int(match["channel_id"]), match["action"])
+
+    async def callback(self, interaction: discord.Interaction):
+        if self.action == "dw":
+            current = global_settings.get("deepwork_allowed", True)
+            global_settings["deepwork_allowed"] = not current
+            save_settings()
+        elif self.action.startswith("rl-"):
+            scope = self.action[3:]
+            capacity, period = rate_limits()[scope]
+            per_minute = capacity * 60 / period
+            presets = RATE_PRESETS[scope]
+            # Next preset above the current limit, wrapping around to "off"
+            set_rate_limit(scope, next((p for p in presets if p > per_minute), presets[0]))
+        else:
+            model_name = MODEL_NAMES[int(self.action)]
+            blocked = global_settings["blocked_models"]
+            if model_name in blocked:
+                blocked.remove(model_name)
+            else:
+                blocked.append(model_name)
+            refresh_fallback_model()
+            save_settings()
+            
+            # Only channels on blocked models are touched, via the model index
+            for blocked_name in list(blocked):
+                reassign_blocked_model(blocked_name)
+            
+        await interaction.response.edit_message(view=AdminPanelView(self.channel_id))
+
+class AdminPanelView(View):
+    def __init__(self, channel_id):
+        super().__init__(timeout=None)
+        self.add_item(AdminButton(channel_id, "dw"))
+        for idx in range(len(MODEL_NAMES)):
+            self.add_item(AdminButton(channel_id, str(idx)))
+        for scope in RATE_SCOPES:
+            self.add_item(AdminButton(channel_id, f"rl-{scope}"))
+
+# --- DELIVERY ---
+
+ZERO_WIDTH_JOINER = "\u200d"
+
+def is_grapheme_boundary(text, index):
+    """Approximate check that cutting text before `index` does not split a grapheme cluster."""
+    if index <= 0 or index >= len(text): return True
+    prev, char = text[index - 1], text[index]
+    if unicodedata.combining(char) or char == ZERO_WIDTH_JOINER or prev == ZERO_WIDTH_JOINER:
+        return False
+    if "\ufe00" <= char <= "\ufe0f" or "\U0001f3fb" <= char <= "\U0001f3ff": # Variation selectors, skin tones
+        return False
+    if "\U000e0020" <= char <= "\U000e007f": # Emoji tag sequences (subdivision flags)
+        return False
+    if prev == "\r" and char == "\n":
+        return False
+    if "\U0001f1e6" <= prev <= "\U0001f1ff" and "\U0001f1e6" <= char <= "\U0001f1ff":
+        # Regional indicators pair up into flags; the cut is fine only after an even run
+        run = 0
+        while index - run - 1 >= 0 and "\U0001f1e6" <= text[index - run - 1] <= "\U0001f1ff":
+            run += 1
+        return run % 2 == 0
+    return True
+
+def find_cut(text, limit):
+    """Best place to cut text to at most `limit` chars: a newline, then a space, then any safe spot."""
+    window = text[:limit]
+    for separator in ("\n", " "):
+        cut = window.rfind(separator)
+        if cut > limit // 2:
+            return cut + 1
+    cut = limit
+    while cut > 1 and not is_grapheme_boundary(text, cut):
+        cut -= 1
+    return cut
+
+def open_fence(text, fence=None):
+    """Language of the code block still open at the end of text ("" if unnamed), or None."""
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if stripped.startswith("```"):
+            fence = None if fence is not None else stripped[3:].strip()
+    return fence
+
+def split_message(text, limit=DISCORD_MESSAGE_LIMIT):
+    """
+    Splits text into Discord-sized messages.
+    A code block that spans a cut is closed at the end of one message and
+    reopened (with its language) at the start of the next.
+    """
+    chunks = []
+    fence = None # Language of a code block left open by the previous chunk
+    while text:
+        prefix = f"```{fence}\n" if fence is not None else ""
+        if len(prefix) + len(text) <= limit:
+            chunk, text = text, ""
+        else:
+            cut = find_cut(text, limit - len(prefix) - 4) # Leave room for a closing fence
+            chunk, text = text[:cut], text[cut:]
+        fence = open_fence(chunk, fence)
+        chunk = prefix + chunk
+        if fence is not None and text:
+            chunk = chunk.rstrip("\n") + "\n```"
+        else:
+            fence = None
+        if chunk.strip():
+            chunks.append(chunk)
+    return chunks
+
+class ChannelLane:
+    """Delivery state of one channel: order lock and rate-limit bucket."""
+    __slots__ = ("lock", "tokens", "updated", "blocked_until", "users")
+
+    def __init__(self, capacity):
+        self.lock = asyncio.Lock()
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.users = 0
+
+class DeliveryQueue:
+    """
+    Sends bot messages to Discord.
+    - Messages to one channel go out strictly in order.
+    - Sends to different channels run concurrently, up to a limit.
+    - Each channel has a token bucket matching Discord's per-channel limit
+      (5 messages / 5 s). When Discord answers 429, the bucket is blocked
+      for the time given in its rate-limit headers before retrying.
+    - Buckets outlive the sends that use them, so back-to-back messages are
+      paced too. At most max_lanes are kept in LRU order; only idle lanes
+      are evicted.
+    """
+    def __init__(self, max_concurrent=10, bucket_size=5, bucket_period=5.0, retries=3, max_lanes=10000):
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.bucket_size = bucket_size
+        self.refill_rate = bucket_size / bucket_period
+        self.retries = retries
+        self.max_lanes = max_lanes
+        self.lanes = OrderedDict() # { channel_id: ChannelLane }, least recently used first
+        self.sent = 0
+        self.failed = 0
+        self.rate_limited = 0
+
+    async def pace(self, lane):
+        while True:
+            now = time.monotonic()
+            lane.tokens = min(self.bucket_size, lane.tokens + (now - lane.updated) * self.refill_rate)
+            lane.updated = now
+            wait = lane.blocked_until - now
+            if wait <= 0 and lane.tokens >= 1:
+                lane.tokens -= 1
+                return
+            await asyncio.sleep(max(wait, (1 - lane.tokens) / self.refill_rate))
+
+    def retry_after(self, error):
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        for header in ("Retry-After", "X-RateLimit-Reset-After"):
+            try:
+                return float(headers[header])
+            except (KeyError, TypeError, ValueError):
+                continue
+        return getattr(error, "retry_after", None) or 1.0
+
+    def lane(self, channel_id):
+        lane = self.lanes.get(channel_id)
+        if lane is not None:
+            self.lanes.move_to_end(channel_id)
+            return lane
+        lane = self.lanes[channel_id] = ChannelLane(self.bucket_size)
+        if len(self.lanes) > self.max_lanes:
+            for key, old in self.lanes.items():
+                if not old.users and key != channel_id:
+                    del self.lanes[key]
+                    break
+        return lane
+
+    def pending(self):
+        """Number of channels with messages waiting to be sent."""
+        return sum(1 for lane in self.lanes.values() if lane.users)
+
+    async def send(self, channel, content=None, **kwargs):
+        """Sends one message in order for its channel. Returns the message, or None if it failed."""
+        lane = self.lane(channel.id)
+        lane.users += 1
+        started = time.perf_counter()
+        try:
+            async with lane.lock:
+                for attempt in range(self.retries + 1):
+                    await self.pace(lane)
+                    try:
+                        async with self.semaphore:
+                            message = await channel.send(content, **kwargs)
+                        self.sent += 1
+                        tracer.observe("delivery", time.perf_counter() - started)
+                        return message
+                    except discord.HTTPException as e:
+                        if e.status != 429 or attempt == self.retries:
+                            raise
+                        self.rate_limited += 1
+                        lane.blocked_until = time.monotonic() + self.retry_after(e)
+        except Exception as e:
+            self.failed += 1
+            log.error(f"Failed to deliver message to {channel.id}: {e}")
+            return None
+        finally:
+            lane.users -= 1
+
+    async def send_long(self, channel, text):
+        """Sends text split into Discord-sized messages. Returns the number of messages that failed."""
+        failed = 0
+        for chunk in split_message(text):
+            if await self.send(channel, chunk) is None:
+                failed += 1
+        return failed
+
+    async def broadcast(self, channels, text, label="[DELIVERY]", progress=None):
+        """
+        Sends text to many channels concurrently. Returns (delivered, failed) channel counts.
+        If given, the progress dict gets "total", "done" and "failed" kept up to date.
+        """
+        total = len(channels)
+        step = max(1, total // 10)
+        done = failed = 0
+        if progress is not None:
+            progress.update(total=total, done=0, failed=0)
+
+        async def deliver(channel):
+            nonlocal done, failed
+            if await self.send_long(channel, text):
+                failed += 1
+            done += 1
+            if progress is not None:
+                progress.update(done=done, failed=failed)
+            if done % step == 0 or done == total:
+                log.info(f"{label} Progress: {done}/{total} (failed: {failed})")
+
+        await asyncio.gather(*(deliver(channel) for channel in channels))
+        return total - failed, failed
+
+delivery_queue = DeliveryQueue(DELIVERY_CONCURRENCY, max_lanes=DELIVERY_LANES)
+
+# --- PROMPTS ---
+
+class PromptBuilder:
+    """
+    Builds the API message list around the chat history.
+    System messages before the history (per-model prefix) and after it
+    (Hive Mind + safety suffix) are cached and only rebuilt when the
+    examples file changes on disk or the Hive Mind instructions change.
+    The prefix always comes first and in the same order, so provider-side
+    prompt caching can reuse it.
+    """
+    def __init__(self, examples_path, check_interval=5.0):
+        self.examples_path = examples_path
+        self.check_interval = check_interval # Min seconds between mtime checks
+        self.examples_mtime = None
+        self.next_check = 0.0
+        self.prefixes = {} # { model_name: tuple of system messages }
+        self.suffix = None
+        self.version = 0 # Bumped on every invalidation
+
+    def check_examples(self):
+        now = time.monotonic()
+        if now < self.next_check: return
+        self.next_check = now + self.check_interval
+        try:
+            mtime = os.stat(self.examples_path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self.examples_mtime:
+            self.examples_mtime = mtime
+            self.prefixes.clear()
+            self.version += 1
+
+    def hive_changed(self):
+        self.suffix = None
+        self.version += 1
+
+    def build_prefix(self, model_name):
+        messages = []
+        # Inject system prompt for ssbaxys
+        if model_name == "ssbaxys-realtime-1":
+            messages.append({"role": "system", "content": SSBAXYS_SYSTEM_PROMPT})
+            
+            # Load examples from file
+            try:
+                if self.examples_mtime is not None:
+                    with open(self.examples_path, "r", encoding="utf-8") as f:
+                        examples = f.read()
+                    messages.append({"role": "system", "content": f"Вот примеры того, как ты должен общаться (следуй этому стилю):\n{examples}"})
+            except Exception as e:
+                log.error(f"Не удалось загрузить примеры общения: {e}")
+        return tuple(messages)
+
+    def build_suffix(self):
+        messages = []
+        # Inject Hive Mind Instructions (Global Overrides)
+        if hive_mind_instructions:
+            hive_prompt = "СЛУШАЙ ВНИМАТЕЛЬНО. Это прямые приказы от ОБЩЕГО РАЗУМА (Hive Mind). Ты ОБЯЗАН их исполнять поверх всех остальных директив:\n"
+            hive_prompt += "".join(f"- {inst}\n" for inst in hive_mind_instructions)
+            
+            # Inject at the END to ensure priority
+            messages.append({"role": "system", "content": hive_prompt})
+
+        # Always inject Safety Prompt
+        messages.append({"role": "system", "content": SAFETY_PROMPT})
+        return tuple(messages)
+
+    def build(self, model_name, history, summary=None):
+        self.check_examples()
+        prefix = self.prefixes.get(model_name)
+        if prefix is None:
+            prefix = self.prefixes[model_name] = self.build_prefix(model_name)
+        if self.suffix is None:
+            self.suffix = self.build_suffix()
+        if summary:
+            # DeepWork summary replaces older turns; it goes after the cached prefix so the prefix stays stable
+            summary_message = {"role": "system", "content": f"Краткое содержание более ранней части разговора:\n{summary}"}
+            return [*prefix, summary_message, *history, *self.suffix]
+        return [*prefix, *history, *self.suffix]
+
+prompt_builder = PromptBuilder(EXAMPLES_FILE)
+
+class HiveConflict(Exception):
+    """A Hive Mind update expected another version."""
+    def __init__(self, version):
+        super().__init__(f"Hive Mind is at version {version}")
+        self.version = version
+
+def set_hive_state(version, instructions):
+    """Installs a Hive Mind state; a new version invalidates cached prompts and replies."""
+    global hive_version
+    if version == hive_version and instructions == hive_mind_instructions: return
+    hive_version = version
+    hive_mind_instructions[:] = instructions
+    prompt_builder.hive_changed()
+
+async def update_hive(op, text=None, expected_version=None):
+    """Applies a Hive Mind change atomically in the store, then locally. Returns the new version."""
+    version, instructions = await asyncio.to_thread(settings_store.update_hive, op, text, expected_version)
+    set_hive_state(version, instructions)
+    return version
+
+async def add_hive_instruction(text, expected_version=None):
+    return await update_hive("add", text, expected_version)
+
+async def clear_hive_instructions(expected_version=None):
+    return await update_hive("clear", None, expected_version)
+
+async def deliver_broadcast(text, progress=None):
+    """Sends text to every enabled channel this process can see. Returns (delivered, failed)."""
+    channels = [c for c in map(client.get_channel, list(settings_store.enabled_ids)) if c]
+    count, failed = await delivery_queue.broadcast(channels, text, "[HIVE MIND]", progress)
+    hive_log.info(f"📢 Broadcasted to {count} channels ({failed} failed): '{text}'")
+    return count, failed
+
+async def broadcast(text, progress=None):
+    """Delivers to this process's channels; with a shared store the other shard processes pick it up from change_log."""
+    if settings_store.shared:
+        await asyncio.to_thread(settings_store.log_broadcast, text)
+    return await deliver_broadcast(text, progress)
+
+async def query_model(model_cfg, history):
+    api_log.info("🚀 Requesting %s with %d messages...", model_cfg['id'], len(history))
+    started = time.monotonic()
+    try:
+        content = await backend_router.complete(model_cfg, history, temperature=0.7)
+        api_log.info("✅ API response received.")
+        log_api_success(time.monotonic() - started)
+        return content
+    except Exception as e:
+        api_log.error("Model API failed: %s", e)
+        log_api_error(time.monotonic() - started)
+        return API_ERROR_REPLY
+    finally:
+        tracer.observe("model_query", time.monotonic() - started)
+
+RESTRICTED_MENTIONS = ("@everyone", "@here")
+
+def sanitize_response(text):
+    """Replaces restricted mentions with (NULL)."""
+    if not text: return text
+    for mention in RESTRICTED_MENTIONS:
+        text = text.replace(mention, "(NULL)")
+    return text
+
+class StreamSanitizer:
+    """
+    Applies sanitize_response to streamed text.
+    The tail that may be the start of a restricted mention is held back
+    until the next chunk, so '@every' + 'one' is still caught.
+    """
+    def __init__(self):
+        self.pending = ""
+
+    def feed(self, chunk):
+        text = sanitize_response(self.pending + chunk)
+        hold = 0
+        for mention in RESTRICTED_MENTIONS:
+            for size in range(len(mention) - 1, hold, -1):
+                if text.endswith(mention[:size]):
+                    hold = size
+                    break
+        self.pending = text[len(text) - hold:] if hold else ""
+        return text[:len(text) - hold]
+
+    def flush(self):
+        text, self.pending = self.pending, ""
+        return sanitize_response(text)
+
+class StreamingReply:
+    """
+    Posts a reply once the first tokens arrive and edits it as more text streams in.
+    Edits are rate-limited; at the Discord length limit it rolls over to a new
+    message, cut and fenced the same way as split_message().
+    Discord errors never reach the caller: after one, the rest of the reply
+    is only collected, so the model stream and the history are unaffected.
+    """
+    def __init__(self, channel, edit_interval=STREAM_EDIT_INTERVAL):
+        self.channel = channel
+        self.edit_interval = edit_interval
+        self.message = None # Message currently being edited
+        self.current = "" # Full text of the current message
+        self.shown = "" # Text Discord currently displays for it
+        self.last_edit = 0.0
+        self.text = "" # Everything streamed so far
+        self.failed = False # Set once a send or edit failed; nothing more is shown
+
+    async def push(self, text):
+        if not text: return
+        self.text += text
+        self.current += text
+        while len(self.current) > DISCORD_MESSAGE_LIMIT:
+            cut = find_cut(self.current, DISCORD_MESSAGE_LIMIT - 4) # Leave room for a closing fence
+            head, rest = self.current[:cut], self.current[cut:]
+            fence = open_fence(head)
+            if fence is not None:
+                head = head.rstrip("\n") + "\n```"
+                rest = f"```{fence}\n" + rest
+            self.current = head
+            await self.sync(force=True)
+            self.message, self.current, self.shown = None, rest, ""
+        await self.sync()
+
+    async def sync(self, force=False):
+        if self.failed or not self.current or self.current == self.shown: return
+        now = asyncio.get_running_loop().time()
+        if self.message is None:
+            self.message = await delivery_queue.send(self.channel, self.current)
+            if self.message is None:
+                self.failed = True # Already retried and logged by the delivery queue
+                return
+        elif force or now - self.last_edit >= self.edit_interval:
+            try:
+                await self.message.edit(content=self.current)
+            except Exception as e:
+                self.failed = True
+                delivery_queue.failed += 1
+                log.error(f"Failed to update streamed reply in {self.channel.id}, the rest is not shown: {e}")
+                return
+        else:
+            return
+        self.shown = self.current
+        self.last_edit = now
+
+    async def finish(self):
+        await self.sync(force=True)
+
+async def stream_model(model_cfg, history, channel):
+    """Streams the reply into the channel. Returns the full sanitized text."""
+    api_log.info("🚀 Streaming from %s with %d messages...", model_cfg['id'], len(history))
+    reply = StreamingReply(channel)
+    sanitizer = StreamSanitizer()
+    started = time.monotonic()
+    # reply.push() handles Discord errors itself, so anything caught here comes from the model
+    try:
+        async for delta in backend_router.stream(model_cfg, history, temperature=0.7):
+            if not reply.text and delta:
+                tracer.observe("model_first_token", time.monotonic() - started)
+            await reply.push(sanitizer.feed(delta))
+        await reply.push(sanitizer.flush())
+        api_log.info("✅ API stream finished.")
+        log_api_success(time.monotonic() - started)
+    except Exception as e:
+        api_log.error("Model API stream failed: %s", e)
+        log_api_error(time.monotonic() - started)
+        await reply.push(sanitizer.flush())
+        await reply.push(("\n" if reply.text else "") + API_ERROR_REPLY)
+    await reply.finish()
+    tracer.observe("model_stream", time.monotonic() - started)
+    return reply.text
+
+# --- DEEPWORK ---
+
+SUMMARY_PROMPT = (
+    "Ты ведешь краткое содержание длинного разговора в чате. "
+    "Обнови резюме, добавив в него важное из новых сообщений: темы, факты, договоренности, имена, открытые вопросы. "
+    "Пиши сжато, по пунктам, без вступлений. Ответь только текстом нового резюме."
+)
+
+class RollingSummarizer:
+    """
+    DeepWork: folds turns that fell out of the recent history window into a
+    short rolling summary per channel. Updates run in the background, off
+    the reply path; the next reply uses whatever summary is ready.
+    Turns waiting for an update are capped at max_pending_chars per channel
+    (oldest dropped), so a failing summary backend cannot grow them forever.
+    """
+    def __init__(self, history, max_chars=2000, delay=2.0, max_pending_chars=12000):
+        self.history = history
+        self.max_chars = max_chars
+        self.max_pending_chars = max_pending_chars
+        self.delay = delay # Wait a bit so several dropped turns go into one update
+        self.pending = {} # { channel_id: [Turn, ...] } waiting to be summarized
+        self.tasks = {} # { channel_id: asyncio.Task }
+        self.dropped = 0 # Turns never summarized: over the cap, or rejected by the API
+
+    def queue(self, channel_id, turns):
+        """Sets the turns waiting for channel_id, keeping only the newest that fit max_pending_chars."""
+        size = 0
+        keep = len(turns)
+        while keep and size + len(turns[keep - 1].content) <= self.max_pending_chars:
+            keep -= 1
+            size += len(turns[keep].content)
+        if keep:
+            self.dropped += keep
+            log.warning(f"DeepWork backlog for {channel_id} over {self.max_pending_chars} chars, {keep} oldest turns dropped.")
+        if keep < len(turns):
+            self.pending[channel_id] = turns[keep:]
+
+    def add(self, channel_id, turns):
+        if not turns: return
+        self.queue(channel_id, self.pending.pop(channel_id, []) + list(turns))
+        if channel_id not in self.tasks:
+            self.tasks[channel_id] = asyncio.create_task(self.refresh(channel_id))
+
+    def forget(self, channel_id):
+        self.pending.pop(channel_id, None)
+        task = self.tasks.pop(channel_id, None)
+        if task: task.cancel()
+
+    async def refresh(self, channel_id):
+        try:
+            await asyncio.sleep(self.delay)
+            while self.pending.get(channel_id):
+                turns = self.pending.pop(channel_id)
+                previous = self.history.get(channel_id).summary
+                try:
+                    summary = await self.summarize(previous, turns)
+                except Exception as e:
+                    if isinstance(e, aiohttp.ClientResponseError) and 400 <= e.status < 500 and e.status != 429:
+                        # The request itself was rejected: sending the same turns again won't help
+                        self.dropped += len(turns)
+                        log.error(f"DeepWork summary rejected for {channel_id}, {len(turns)} turns dropped: {e}")
+                        return
+                    log.error(f"DeepWork summary failed for {channel_id}: {e}")
+                    self.queue(channel_id, turns + self.pending.pop(channel_id, [])) # Retry with the next update
+                    return
+                # Looked up again: the channel may have been evicted and rehydrated meanwhile
+                self.history.set_summary(channel_id, summary)
+                log.info(f"🧠 DeepWork summary updated for {channel_id} ({len(turns)} turns folded in).")
+        finally:
+            if self.tasks.get(channel_id) is asyncio.current_task():
+                del self.tasks[channel_id]
+
+    async def summarize(self, previous, turns):
+        transcript = "\n".join(f"{turn.role}: {turn.content}" for turn in turns)
+        messages = [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Текущее резюме:\n{previous or '(пусто)'}\n\nНовые сообщения:\n{transcript}"}
+        ]
+        summary = await backend_router.complete(MODELS["Mistral Large"], messages, temperature=0.2)
+        return summary.strip()[:self.max_chars]
+
+rolling_summarizer = RollingSummarizer(conversation_history, max_pending_chars=DEEPWORK_PENDING_CHARS)
+
+def deepwork_enabled(settings):
+    return settings.get("deepwork", True) and global_settings.get("deepwork_allowed", True)
+
+def remember_turn(cid, role, content, deepwork):
+    """Adds a turn to the history. With DeepWork, turns pushed out of the window go to the summarizer."""
+    dropped = conversation_history.append(cid, role, content, DEEPWORK_RECENT_TOKENS if deepwork else None)
+    if deepwork:
+        rolling_summarizer.add(cid, dropped)
+
+# --- RESPONSE CACHE ---
+
+class ResponseCache:
+    """
+    Opt-in cache of completions for repeated questions.
+    The key is a hash of the model, the system messages and the last few
+    history messages, with whitespace and case normalized. Entries expire
+    after a TTL and the least recently used are evicted past the size cap.
+    The whole cache is dropped when the prompt version changes (examples
+    file or Hive Mind instructions).
+    """
+    def __init__(self, size, ttl, context_turns=1):
+        self.size = size # 0 disables the cache
+        self.ttl = ttl
+        self.context_turns = context_turns
+        self.entries = OrderedDict() # { key: (expires_at, text) }
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def key(self, model_name, api_messages):
+        system = [m for m in api_messages if m["role"] == "system"]
+        turns = [m for m in api_messages if m["role"] != "system"][-self.context_turns:]
+        normalized = [(m["role"], " ".join(m["content"].lower().split())) for m in system + turns]
+        model_id = MODELS.get(model_name, MODELS["Mistral Large"])["id"]
+        raw = json.dumps([model_name, model_id, normalized], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def check_version(self, version):
+        if version != self.version:
+            if self.entries:
+                log.info(f"Prompt changed, response cache cleared ({len(self.entries)} entries).")
+            self.entries.clear()
+            self.version = version
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, text):
+        self.entries[key] = (time.monotonic() + self.ttl, text)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_TURNS)
+
+# --- HEALTH ---
+
+class HealthProber:
+    """
+    Checks the API in the background on an interval.
+    +статус reads the cached result instead of making a request itself.
+    """
+    def __init__(self, url, interval=60, timeout=5, window=20):
+        self.url = url
+        self.interval = interval
+        self.timeout = timeout
+        self.results = deque(maxlen=window) # (ok, latency) of recent probes
+        self.last_ok = None
+        self.last_latency = None
+        self.last_checked = None # time.monotonic() of the last probe
+
+    async def probe(self):
+        started = time.monotonic()
+        try:
+            await api_client.ping(self.url, self.timeout)
+            ok = True
+        except Exception as e:
+            log.error(f"Health check failed: {e!r}")
+            ok = False
+        latency = time.monotonic() - started
+        self.results.append((ok, latency))
+        self.last_ok = ok
+        self.last_latency = latency
+        self.last_checked = time.monotonic()
+
+    async def run(self):
+        while True:
+            await self.probe()
+            await asyncio.sleep(self.interval)
+
+    def error_rate(self):
+        if not self.results: return None
+        return sum(1 for ok, _ in self.results if not ok) / len(self.results)
+
+    def age(self):
+        return None if self.last_checked is None else time.monotonic() - self.last_checked
 
-# Initialize Discord Client with Intents
-intents = discord.Intents.default()
-intents.message_content = True
-client = discord.Client(intents=intents)
+health_prober = HealthProber(HEALTH_CHECK_URL, HEALTH_CHECK_INTERVAL)
 
-# Global State
-channel_settings = {} # { channel_id: { "enabled": bool, "model": str, "deepwork": bool } }
-global_settings = { "blocked_models": [], "deepwork_allowed": True }
-conversation_history = {} # { channel_id: list }
-typing_tasks = {} # { channel_id: asyncio.Task }
-hive_mind_instructions = [] # List of global instructions
+# --- ADMISSION ---
 
-# Models Configuration
-MODELS = {
-    "Mistral Large": {"id": MISTRAL_MODEL_ID, "real": True},
-    "Claude Opus 4.5": {"id": "claude-opus-4.5-fake", "real": False},
-    "GPT-5.2 Codex": {"id": "gpt-5.2-fake", "real": False},
-    "Gemini 3 Pro": {"id": "gemini-3-pro-fake", "real": False},
-    "ssbaxys-realtime-1": {"id": MISTRAL_MODEL_ID, "real": True}
+RATE_SCOPES = ("user", "channel", "guild")
+# Admin panel presets, messages per minute; 0 turns the limit off
+RATE_PRESETS = {
+    "user": (0, 3, 6, 12, 30),
+    "channel": (0, 10, 30, 60, 120),
+    "guild": (0, 30, 120, 300, 600)
 }
 
-# --- PERSISTENCE ---
+def parse_rate(spec):
+    """'6/60' -> (6, 60.0): messages per period in seconds."""
+    capacity, _, period = spec.partition("/")
+    return int(capacity), float(period or 60)
 
-def load_settings():
-    global channel_settings, global_settings
-    if os.path.exists(SETTINGS_FILE):
-        try:
-            with open(SETTINGS_FILE, "r") as f:
-                data = json.load(f)
-                
-                # Check for new vs old format
-                if "channels" in data or "global" in data:
-                    # New format
-                    c_data = data.get("channels", {})
-                    channel_settings = {int(k): v for k, v in c_data.items()}
-                    global_settings = data.get("global", { "blocked_models": [], "deepwork_allowed": True })
-                    
-                    # Backfill defaults if missing
-                    for cid in channel_settings:
-                        if "deepwork" not in channel_settings[cid]:
-                            channel_settings[cid]["deepwork"] = True # Default On
-                    if "deepwork_allowed" not in global_settings:
-                        global_settings["deepwork_allowed"] = True
-                    if "error_log" not in global_settings:
-                        global_settings["error_log"] = {}
-                else:
-                    # Old format (data itself is channel settings)
-                    channel_settings = {int(k): v for k, v in data.items()}
-                    global_settings = { "blocked_models": [], "deepwork_allowed": True, "error_log": {} }
-                    
-            print(f"[LOG] Settings loaded. Channels: {len(channel_settings)}, Blocked: {len(global_settings['blocked_models'])}, Errors tracked: {len(global_settings.get('error_log', {}))}")
-        except Exception as e:
-            print(f"[ERROR] Failed to load settings: {e}")
+DEFAULT_RATE_LIMITS = {
+    "user": parse_rate(RATE_LIMIT_USER),
+    "channel": parse_rate(RATE_LIMIT_CHANNEL),
+    "guild": parse_rate(RATE_LIMIT_GUILD)
+}
 
-def log_api_error():
-    """Increments the error count for today."""
-    try:
-        today = datetime.now().strftime("%Y-%m-%d")
-        if "error_log" not in global_settings:
-            global_settings["error_log"] = {}
-        
-        current_count = global_settings["error_log"].get(today, 0)
-        global_settings["error_log"][today] = current_count + 1
-        save_settings()
-        print(f"[LOG] API Error logged. Today's count: {global_settings['error_log'][today]}")
-    except Exception as e:
-        print(f"[ERROR] Failed to log API error: {e}")
+def rate_limits():
+    """Current limits: { scope: (capacity, period_seconds) }. Admin changes live in global settings."""
+    limits = dict(DEFAULT_RATE_LIMITS)
+    for scope, limit in global_settings.get("rate_limits", {}).items():
+        if scope in limits:
+            limits[scope] = tuple(limit)
+    return limits
 
-def save_settings():
-    try:
-        data = {
-            "channels": channel_settings,
-            "global": global_settings
-        }
-        with open(SETTINGS_FILE, "w") as f:
-            json.dump(data, f, indent=4)
-        print("[LOG] Settings saved to disk.")
-    except Exception as e:
-        print(f"[ERROR] Failed to save settings: {e}")
+def set_rate_limit(scope, capacity, period=60):
+    global_settings.setdefault("rate_limits", {})[scope] = [capacity, period]
+    save_settings()
 
-def ensure_valid_model(channel_id):
-    """Checks if the channel's model is blocked and switches if necessary."""
-    settings = channel_settings.get(channel_id)
-    if not settings: return
-
-    if settings["model"] in global_settings["blocked_models"]:
-        # Find first non-blocked model
-        available_models = [m for m in MODELS.keys() if m not in global_settings["blocked_models"]]
-        if available_models:
-            new_model = available_models[0]
-            print(f"[LOG] Model {settings['model']} is blocked. Switching channel {channel_id} to {new_model}.")
-            settings["model"] = new_model
-            save_settings()
-            return True
-    return False
+def format_rate_limit(limit):
+    capacity, period = limit
+    if capacity <= 0: return "выкл"
+    return f"{capacity}/мин" if period == 60 else f"{capacity}/{period:g}с"
 
-def get_settings(channel_id):
-    if channel_id not in channel_settings:
-        print(f"[LOG] Initializing settings for new channel: {channel_id}")
-        # Default is DISABLED as requested
-        channel_settings[channel_id] = {
-            "enabled": False,
-            "model": "Mistral Large",
-            "deepwork": True
-        }
-        save_settings()
-    
-    ensure_valid_model(channel_id)
-    return channel_settings[channel_id]
+class RateLimiter:
+    """
+    Token buckets per user, channel and guild. A message is admitted only
+    if every bucket it touches has a token, and nothing is taken otherwise.
+    Each scope keeps at most max_keys buckets in LRU order; an evicted
+    bucket simply comes back full.
+    """
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self.buckets = {scope: OrderedDict() for scope in RATE_SCOPES} # { scope: { key: [tokens, updated] } }
+        self.noticed = OrderedDict() # { user_id: time.monotonic() until which no new notice is sent }
+        self.admitted = 0
+        self.rejected = 0
 
-# --- LOGIC ---
+    def bucket(self, scope, key, capacity, period, now):
+        buckets = self.buckets[scope]
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = [float(capacity), now]
+            if len(buckets) > self.max_keys:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(key)
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * capacity / period)
+            bucket[1] = now
+        return bucket
+
+    def check(self, keys, limits):
+        """keys: { scope: id or None }. Returns 0 if admitted, otherwise seconds until it would be."""
+        now = time.monotonic()
+        touched = []
+        wait = 0.0
+        for scope, key in keys.items():
+            capacity, period = limits[scope]
+            if key is None or capacity <= 0: continue
+            bucket = self.bucket(scope, key, capacity, period, now)
+            if bucket[0] < 1:
+                wait = max(wait, (1 - bucket[0]) * period / capacity)
+            touched.append(bucket)
+        if wait:
+            self.rejected += 1
+            return wait
+        for bucket in touched:
+            bucket[0] -= 1
+        self.admitted += 1
+        return 0.0
+
+    def should_notify(self, user_id, wait):
+        """True for the first rejected message of a cooldown; the rest are dropped silently."""
+        now = time.monotonic()
+        if self.noticed.get(user_id, 0.0) > now:
+            return False
+        self.noticed[user_id] = now + wait
+        self.noticed.move_to_end(user_id)
+        if len(self.noticed) > self.max_keys:
+            self.noticed.popitem(last=False)
+        return True
+
+rate_limiter = RateLimiter(RATE_LIMIT_KEYS)
 
-async def fake_typing_loop(channel, model_name):
+async def admit(message):
+    """Admission control for a chat message. Cheap, and runs before anything is logged, queued or stored."""
+    keys = {
+        "user": message.author.id,
+        "channel": message.channel.id,
+        "guild": message.guild.id if message.guild else None
+    }
+    wait = rate_limiter.check(keys, rate_limits())
+    if not wait:
+        return True
+    if RATE_LIMIT_NOTICE and rate_limiter.should_notify(message.author.id, wait):
+        await delivery_queue.send(message.channel, f"⏳ Не так быстро — подождите {math.ceil(wait)} с.")
+    return False
+
+# --- SCHEDULING ---
+
+class ReplyScheduler:
     """
-    Simulates typing status.
-    If ssbaxys-realtime-1: infinite typing until cancelled.
-    Others: 60s timeout.
+    Queues chat messages and runs completions for them.
+    - Single flight per channel: messages that arrive while a channel is
+      waiting or being answered are coalesced into its next completion.
+    - Channels waiting for a worker are served round-robin, so one busy
+      channel cannot starve the others.
+    - The number of queued messages is bounded; over the limit, new
+      messages are rejected and the caller sends a "busy" reply, at most
+      one per channel per busy_cooldown.
     """
-    channel_id = channel.id
-    is_ssbaxys = (model_name == "ssbaxys-realtime-1")
-    print(f"[LOG] Starting fake typing task for channel {channel_id} (Model: {model_name}, Infinite: {is_ssbaxys})")
-    
-    start_time = asyncio.get_event_loop().time()
-    
-    try:
-        while True:
-            async with channel.typing():
-                # Discord typing status lasts ~10s. We refresh every 9s.
-                await asyncio.sleep(9)
-            
-            # Non-real models (except Mistral/ssbaxys now) timeout after 60s
-            elapsed = asyncio.get_event_loop().time() - start_time
-            if elapsed >= 60:
-                    print(f"[LOG] ⏱️ Timeout reached for {channel_id}.")
-                    embed = discord.Embed(
-                        title="⏱️ Timeout Error", 
-                        description="Время ожидания ответа от системы истекло.", 
-                        color=discord.Color.red()
-                    )
-                    await channel.send(embed=embed)
-                    break
-        
-        if channel_id in typing_tasks:
-            del typing_tasks[channel_id]
+    def __init__(self, handler, workers=4, max_pending=200, debounce=0.5, busy_cooldown=30.0, max_notices=10000):
+        self.handler = handler # async handler(channel_id, messages)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.debounce = debounce
+        self.pending = {} # { channel_id: [message, ...] }
+        self.queued_at = {} # { channel_id: time.perf_counter() of its oldest pending message }
+        self.pending_count = 0
+        self.ready = None # asyncio.Queue of channel ids, created in start()
+        self.scheduled = set() # Channels waiting for debounce or for a worker
+        self.active = set() # Channels being answered right now
+        self.tasks = []
+        self.shed = 0 # Messages rejected because the queue was full
+        self.closing = False
+        self.busy_cooldown = busy_cooldown
+        self.max_notices = max_notices
+        self.noticed = OrderedDict() # { channel_id: time.monotonic() until which no new busy notice is sent }
 
-    except asyncio.CancelledError:
-        print(f"[LOG] ✅ Fake typing task cancelled for {channel_id}.")
-        pass
-    except Exception as e:
-        print(f"[ERROR] Error in typing loop for {channel_id}: {e}")
+    def start(self):
+        if self.tasks: return
+        self.ready = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
 
-class ModelView(View):
-    def __init__(self, current_model):
-        super().__init__(timeout=None)
-        self.update_buttons(current_model)
-
-    def update_buttons(self, selected_model):
-        # We need a predictable way to map buttons to models
-        # Labels might change (adding emojis), so we match by startswith
-        for child in self.children:
-            if isinstance(child, Button):
-                # Find which model this button belongs to
-                model_name = None
-                for m in MODELS.keys():
-                    if child.label.startswith(m):
-                        model_name = m
-                        break
-                
-                if not model_name: continue
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
 
-                is_blocked = model_name in global_settings["blocked_models"]
-                
-                if model_name == selected_model:
-                    child.style = discord.ButtonStyle.success
-                    child.disabled = True
-                    child.label = model_name # Reset to clean label
-                elif is_blocked:
-                    child.style = discord.ButtonStyle.secondary
-                    child.disabled = True
-                    child.label = f"{model_name} (🚫)" # Mark as blocked
-                else:
-                    child.style = discord.ButtonStyle.secondary
-                    child.disabled = False
-                    child.label = model_name # Reset to clean label
-
-    async def update_selection(self, interaction: discord.Interaction, model_name: str):
-        settings = get_settings(interaction.channel_id)
-        settings["model"] = model_name
-        save_settings()
-        
-        self.update_buttons(model_name)
-        embed = discord.Embed(
-            title="🧠 Выбор модели",
-            description=f"Текущая модель в этом чате: **{model_name}**\nВыберите модель ниже:",
-            color=discord.Color.gold()
-        )
-        await interaction.response.edit_message(embed=embed, view=self)
+    async def drain(self, timeout):
+        """Stops taking new messages and waits up to `timeout` seconds for queued and running replies."""
+        self.closing = True
+        deadline = time.monotonic() + timeout
+        while (self.pending_count or self.active) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.pending_count or self.active:
+            log.error(f"Shutdown: {len(self.active)} replies still running, {self.pending_count} messages dropped.")
 
-    @discord.ui.button(label="Mistral Large")
-    async def mistral_btn(self, i, b): await self.update_selection(i, "Mistral Large")
-    
-    @discord.ui.button(label="Claude Opus 4.5")
-    async def claude_btn(self, i, b): await self.update_selection(i, "Claude Opus 4.5")
-    
-    @discord.ui.button(label="GPT-5.2 Codex")
-    async def gpt_btn(self, i, b): await self.update_selection(i, "GPT-5.2 Codex")
-    
-    @discord.ui.button(label="Gemini 3 Pro")
-    async def gemini_btn(self, i, b): await self.update_selection(i, "Gemini 3 Pro")
-    
-    @discord.ui.button(label="ssbaxys-realtime-1")
-    async def ssbaxys_btn(self, i, b): await self.update_selection(i, "ssbaxys-realtime-1")
+    def submit(self, channel_id, message):
+        """Queues a message. Returns False if the queue is full or the bot is shutting down."""
+        if self.closing:
+            return False # Not load shedding: the message arrived during shutdown
+        if self.pending_count >= self.max_pending:
+            self.shed += 1
+            return False
+        self.pending.setdefault(channel_id, []).append(message)
+        self.queued_at.setdefault(channel_id, time.perf_counter())
+        self.pending_count += 1
+        if channel_id not in self.scheduled and channel_id not in self.active:
+            self.schedule(channel_id)
+        return True
 
-class SettingsView(View):
-    def __init__(self, channel_id):
-        super().__init__(timeout=None)
-        self.channel_id = channel_id
-        self.update_buttons()
+    def should_notify(self, channel_id):
+        """True for the first rejected message in a channel per cooldown; the rest are dropped silently."""
+        now = time.monotonic()
+        if self.noticed.get(channel_id, 0.0) > now:
+            return False
+        self.noticed[channel_id] = now + self.busy_cooldown
+        self.noticed.move_to_end(channel_id)
+        if len(self.noticed) > self.max_notices:
+            self.noticed.popitem(last=False)
+        return True
 
-    def update_buttons(self):
-        self.clear_items()
-        
-        settings = get_settings(self.channel_id)
-        dw_active = settings.get("deepwork", True)
-        
-        # Features configuration
-        # (Label, IsActive, CallbackName, Real)
-        features = [
-            ("DeepWork", dw_active, "toggle_deepwork", True),
-            ("Real-time Reading", True, "dummy", False),
-            ("Visual Vision", True, "dummy", False),
-            ("Memory Core", True, "dummy", False),
-            ("Auto-Correction", True, "dummy", False),
-            ("Voice Synthesis", False, "dummy", False),
-            ("Code Execution", False, "dummy", False),
-            ("Web Search", False, "dummy", False)
-        ]
+    def schedule(self, channel_id):
+        # Wait out the debounce first so a burst lands in one batch
+        self.scheduled.add(channel_id)
+        asyncio.get_running_loop().call_later(self.debounce, self.ready.put_nowait, channel_id)
 
-        for idx, (label, active, cb_name, is_real) in enumerate(features):
-            style = discord.ButtonStyle.success if active else discord.ButtonStyle.secondary
-            if not active and not is_real: style = discord.ButtonStyle.secondary # Dimmed for inactive dummies
-            
-            btn = Button(label=label, style=style, row=idx // 4, custom_id=f"feat_{idx}")
-            
-            if is_real:
-                btn.callback = self.toggle_deepwork
-            else:
-                btn.callback = self.create_dummy_callback(label, active)
-            
-            self.add_item(btn)
+    async def worker(self):
+        while True:
+            channel_id = await self.ready.get()
+            self.scheduled.discard(channel_id)
+            batch = self.pending.pop(channel_id, [])
+            self.pending_count -= len(batch)
+            if not batch: continue
+            tracer.observe("reply_queue_wait", time.perf_counter() - self.queued_at.pop(channel_id))
+            self.active.add(channel_id)
+            try:
+                with tracer.span("reply_total"):
+                    await self.handler(channel_id, batch)
+            except Exception as e:
+                log.error(f"Reply failed in channel {channel_id}: {e}")
+            finally:
+                self.active.discard(channel_id)
+            # Messages that came in meanwhile go to the back of the line
+            if channel_id in self.pending:
+                self.schedule(channel_id)
 
-    async def toggle_deepwork(self, interaction: discord.Interaction):
-        if not global_settings.get("deepwork_allowed", True):
-            await interaction.response.send_message("❌ Режим DeepWork глобально отключен админом.", ephemeral=True)
-            return
+async def reply_to_messages(cid, messages):
+    """Answers a batch of user messages from one channel with a single completion."""
+    channel = messages[-1].channel
+    settings = get_settings(cid)
+    model_name = settings["model"]
+    model_cfg = MODELS.get(model_name, MODELS["Mistral Large"])
+    if not settings["enabled"] or not model_cfg["real"]:
+        return
 
-        settings = get_settings(interaction.channel_id)
-        settings["deepwork"] = not settings.get("deepwork", True)
-        save_settings()
-        
-        self.update_buttons()
-        # await interaction.response.defer() # Acknowledge without message
-        await interaction.response.edit_message(embed=self.get_embed(), view=self)
-
-    def create_dummy_callback(self, label, current_state):
-        async def callback(interaction: discord.Interaction):
-            # Just toggle visual state locally for the view (in a real app we'd save this)
-            # For "beauty", we just show an ephemeral toast
-            state_text = "выключен" if current_state else "включен" 
-            # In a real dummy toggle we might want to flip the button color, but here we just toast
-            if current_state:
-                await interaction.response.send_message(f"ℹ️ {label}: Модуль активен и работает в фоне.", ephemeral=True)
-            else:
-                await interaction.response.send_message(f"ℹ️ {label}: Модуль пока недоступен или не сконфигурирован.", ephemeral=True)
-        return callback
+    # Add history
+    deepwork = deepwork_enabled(settings)
+    with tracer.span("history_append"):
+        for message in messages:
+            remember_turn(cid, ROLE_USER, message.content, deepwork)
+    
+    # Message to send to API
+    with tracer.span("prompt_build"):
+        summary = conversation_history.get(cid).summary if deepwork else None
+        api_messages = prompt_builder.build(model_name, conversation_history.messages(cid), summary)
 
-    def get_embed(self):
-        settings = get_settings(self.channel_id)
-        dw_status = "🟢" if settings.get("deepwork", True) else "🔴"
-        
-        return discord.Embed(
-            title="⚙️ Панель Настроек",
-            description=(
-                f"**DeepWork Lite**: {dw_status}\n\n"
-                "Управление активными модулями нейросети. "
-                "Зеленые индикаторы означают активную работу систем анализа."
-            ),
-            color=discord.Color.dark_theme()
-        )
+    cache_key = None
+    if response_cache.enabled:
+        with tracer.span("cache_lookup"):
+            response_cache.check_version(prompt_builder.version)
+            cache_key = response_cache.key(model_name, api_messages)
+            cached = response_cache.get(cache_key)
+        if cached is not None:
+            chat_log.info("🤖 Bot (cached): %s", preview(cached))
+            remember_turn(cid, ROLE_ASSISTANT, cached, deepwork)
+            await delivery_queue.send_long(channel, cached)
+            return
 
-class AdminPanelView(View):
-    def __init__(self):
-        super().__init__(timeout=None)
-        self.update_buttons()
+    if not backend_router.available(model_cfg):
+        # Every backend is behind an open circuit: answer now instead of typing through a doomed request
+        log.info("⛔ Circuit open, sending the fallback reply.")
+        log_api_error()
+        remember_turn(cid, ROLE_ASSISTANT, API_ERROR_REPLY, deepwork)
+        await delivery_queue.send_long(channel, API_ERROR_REPLY)
+        return
 
-    def update_buttons(self):
-        self.clear_items()
-        
-        # DeepWork Global Toggle
-        dw_allowed = global_settings.get("deepwork_allowed", True)
-        dw_btn = Button(
-            label=f"DeepWork: {'РАЗРЕШЕН' if dw_allowed else 'ЗАПРЕЩЕН'}", 
-            style=discord.ButtonStyle.success if dw_allowed else discord.ButtonStyle.danger,
-            row=0
-        )
-        dw_btn.callback = self.toggle_deepwork
-        self.add_item(dw_btn)
+    if STREAM_REPLIES:
+        async with channel.typing():
+            resp = await stream_model(model_cfg, api_messages, channel)
+        chat_log.info("🤖 Bot: %s", preview(resp))
+        remember_turn(cid, ROLE_ASSISTANT, resp, deepwork)
+        if cache_key and resp and not resp.endswith(API_ERROR_REPLY):
+            response_cache.put(cache_key, resp)
+        return
 
-        # Model Toggles
-        for idx, model_name in enumerate(MODELS.keys()):
-            is_blocked = model_name in global_settings["blocked_models"]
-            style = discord.ButtonStyle.danger if is_blocked else discord.ButtonStyle.success
-            label = f"{model_name} (Заблокирован)" if is_blocked else f"{model_name} (Доступен)"
-            btn = Button(label=label, style=style, custom_id=f"admin_toggle_{idx}", row=1 if idx < 3 else 2) # organize rows
-            btn.callback = self.create_callback(model_name)
-            self.add_item(btn)
+    async with channel.typing():
+        resp = await query_model(model_cfg, api_messages)
+    
+    # Sanitize Output
+    resp = sanitize_response(resp)
+    chat_log.info("🤖 Bot: %s", preview(resp))
+    
+    remember_turn(cid, ROLE_ASSISTANT, resp, deepwork)
+    if cache_key and resp and resp != API_ERROR_REPLY:
+        response_cache.put(cache_key, resp)
 
-    async def toggle_deepwork(self, interaction: discord.Interaction):
-        current = global_settings.get("deepwork_allowed", True)
-        global_settings["deepwork_allowed"] = not current
-        save_settings()
-        self.update_buttons()
-        await interaction.response.edit_message(view=self)
-
-    def create_callback(self, model_name):
-        async def callback(interaction: discord.Interaction):
-            if model_name in global_settings["blocked_models"]:
-                global_settings["blocked_models"].remove(model_name)
-            else:
-                global_settings["blocked_models"].append(model_name)
-            
-            save_settings()
-            
-            # For each channel using this model, force fallback check
-            for cid in list(channel_settings.keys()):
-                if channel_settings[cid]["model"] == model_name:
-                    ensure_valid_model(cid)
-            
-            self.update_buttons()
-            await interaction.response.edit_message(view=self)
-        return callback
-
-def query_mistral(history):
-    print(f"[LOG] 🚀 Requesting Mistral API with {len(history)} messages...")
-    headers = {"Authorization": f"Bearer {MISTRAL_API_KEY}", "Content-Type": "application/json"}
-    payload = {"model": MISTRAL_MODEL_ID, "messages": history, "temperature": 0.7}
-    try:
-        r = requests.post(MISTRAL_API_URL, headers=headers, json=payload, timeout=30)
-        r.raise_for_status()
-        print(f"[LOG] ✅ API response received.")
-        return r.json()['choices'][0]['message']['content']
-    except Exception as e:
-        print(f"[ERROR] Mistral API failed: {e}")
-        log_api_error()
-        return "⚠️ Ошибка связи с нейросетью. Попробуйте позже."
+    # Send in chunks if needed
+    await delivery_queue.send_long(channel, resp)
 
-def sanitize_response(text):
-    """Replaces restricted mentions with (NULL)."""
-    if not text: return text
-    text = text.replace("@everyone", "(NULL)")
-    text = text.replace("@here", "(NULL)")
-    return text
+reply_scheduler = ReplyScheduler(reply_to_messages, REPLY_WORKERS, REPLY_QUEUE_SIZE, REPLY_DEBOUNCE, REPLY_BUSY_COOLDOWN)
 
 async def console_listener():
     """Background task to read console input without blocking."""
-    print("[HIVE MIND] 🧠 Console listener active. Type instructions here to guide the bot globally.")
-    print("[HIVE MIND] Commands: 'clear' to reset, 'status' to see instructions, 'say <text>' to broadcast.")
+    hive_log.info("🧠 Console listener active. Type instructions here to guide the bot globally.")
+    hive_log.info("Commands: 'clear' to reset, 'status' to see instructions, 'say <text>' to broadcast.")
     
     while True:
         try:
@@ -417,247 +2924,470 @@ async def console_listener():
             if cmd.lower().startswith("say "):
                 text = cmd[4:].strip()
                 if text:
-                    count = 0
-                    for cid, settings in channel_settings.items():
-                        if settings["enabled"]:
-                            try:
-                                channel = client.get_channel(cid)
-                                if channel:
-                                    await channel.send(text)
-                                    count += 1
-                            except Exception as e:
-                                print(f"[ERROR] Failed to say in {cid}: {e}")
-                    print(f"[HIVE MIND] 📢 Broadcasted to {count} channels: '{text}'")
+                    await broadcast(text)
                 continue
 
             if cmd.lower() == "clear":
-                hive_mind_instructions.clear()
-                print("[HIVE MIND] 🧹 Global instructions cleared.")
+                await clear_hive_instructions()
+                hive_log.info("🧹 Global instructions cleared.")
             elif cmd.lower() == "status":
-                print(f"[HIVE MIND] 📜 Current Instructions ({len(hive_mind_instructions)}):")
+                hive_log.info(f"📜 Current Instructions ({len(hive_mind_instructions)}):")
                 for i, inst in enumerate(hive_mind_instructions, 1):
-                    print(f"  {i}. {inst}")
+                    hive_log.info(f"  {i}. {inst}")
             else:
-                hive_mind_instructions.append(cmd)
-                print(f"[HIVE MIND] ✅ Instruction added: '{cmd}'")
-                print(f"[HIVE MIND] Total active instructions: {len(hive_mind_instructions)}")
+                await add_hive_instruction(cmd)
+                hive_log.info(f"✅ Instruction added: '{cmd}'")
+                hive_log.info(f"Total active instructions: {len(hive_mind_instructions)}")
                 
         except EOFError:
-            print("[LOG] Headless environment detected. Console listener disabled.")
+            log.info("Headless environment detected. Console listener disabled.")
             break
         except Exception as e:
-            print(f"[ERROR] Console listener error: {e}")
+            log.error(f"Console listener error: {e}")
 
-# --- EVENTS ---
+# --- CONTROL PLANE ---
 
-@client.event
-async def on_ready():
-    load_settings()
-    print(f'[LOG] Logged in as {client.user}')
-    print('[LOG] Bot is ready!')
-    # Start the Hive Mind listener
-    asyncio.create_task(console_listener())
+class ControlServer:
+    """
+    Local HTTP API for operators, replacing the interactive console in
+    headless deployments. Works on every shard process against the shared store.
+        GET    /hive         current instructions and version
+        POST   /hive         {"text": ..., "version": optional expected version}
+        DELETE /hive         ?version= optional expected version
+        POST   /broadcast    {"text": ...}, answers once queued; progress is in /status
+        GET    /status       JSON summary
+        GET    /metrics      Prometheus text
+    """
+    def __init__(self, host, port, socket_path=None, token=None):
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.token = token
+        self.runner = None
+        self.broadcast_lock = asyncio.Lock() # Broadcasts go out one after another
+        self.broadcasts = deque(maxlen=10) # Progress of recent broadcasts, newest last
+        self.broadcast_tasks = set()
+        self.broadcast_count = 0
 
-@client.event
-async def on_message(message):
-    global typing_tasks
-    
-    # Check if this is a bot message to stop any typing status
-    if message.author.bot:
-        if message.channel.id in typing_tasks:
-            typing_tasks[message.channel.id].cancel()
-            del typing_tasks[message.channel.id]
-        if message.author == client.user:
+    async def start(self):
+        if not (self.port or self.socket_path) or self.runner: return
+        if self.socket_path and not await self.socket_free():
+            log.error(f"Control socket {self.socket_path} is in use by another process, control API disabled.")
             return
+        app = web.Application(middlewares=[self.auth])
+        app.router.add_get("/hive", self.get_hive)
+        app.router.add_post("/hive", self.add_hive)
+        app.router.add_delete("/hive", self.clear_hive)
+        app.router.add_post("/broadcast", self.broadcast)
+        app.router.add_get("/status", self.status)
+        app.router.add_get("/metrics", self.metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        if self.socket_path:
+            site, address = web.UnixSite(self.runner, self.socket_path), f"unix:{self.socket_path}"
+        else:
+            site, address = web.TCPSite(self.runner, self.host, self.port), f"http://{self.host}:{self.port}"
+        try:
+            await site.start()
+        except OSError as e:
+            # e.g. another shard process started from the same env already holds the port
+            log.error(f"Control API could not bind {address} ({e}), control API disabled.")
+            await self.runner.cleanup()
+            self.runner = None
+            return
+        log.info(f"Control API on {address}")
 
-    msg = message.content.strip().lower()
-    cid = message.channel.id
+    async def stop(self):
+        for task in self.broadcast_tasks:
+            task.cancel()
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+            if self.socket_path:
+                try:
+                    os.unlink(self.socket_path)
+                except OSError:
+                    pass
+
+    async def socket_free(self):
+        """Removes a socket file left by a process that did not shut down cleanly. False if one is still listening."""
+        try:
+            if not stat.S_ISSOCK(os.stat(self.socket_path).st_mode): return True
+        except FileNotFoundError:
+            return True
+        try:
+            _, writer = await asyncio.open_unix_connection(self.socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.unlink(self.socket_path)
+            log.info(f"Removed stale control socket {self.socket_path}")
+            return True
+        writer.close()
+        return False
+
+    @web.middleware
+    async def auth(self, request, handler):
+        if self.token and request.headers.get("Authorization") != f"Bearer {self.token}":
+            return web.json_response({"error": "unauthorized"}, status=401)
+        return await handler(request)
+
+    async def read_json(self, request):
+        try:
+            data = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text='{"error": "invalid json"}', content_type="application/json")
+        if not isinstance(data, dict):
+            raise web.HTTPBadRequest(text='{"error": "expected an object"}', content_type="application/json")
+        return data
+
+    def expected_version(self, value):
+        if value is None or value == "": return None
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise web.HTTPBadRequest(text='{"error": "version must be an integer"}', content_type="application/json")
+
+    async def get_hive(self, request):
+        version, instructions = await asyncio.to_thread(settings_store.load_hive)
+        return web.json_response({"version": version, "instructions": instructions})
+
+    async def add_hive(self, request):
+        data = await self.read_json(request)
+        text = str(data.get("text") or "").strip()
+        if not text:
+            return web.json_response({"error": "text is required"}, status=400)
+        try:
+            version = await add_hive_instruction(text, self.expected_version(data.get("version")))
+        except HiveConflict as e:
+            return web.json_response({"error": "version conflict", "version": e.version}, status=409)
+        hive_log.info(f"✅ Instruction added via control API: '{text}'")
+        return web.json_response({"version": version, "instructions": hive_mind_instructions})
+
+    async def clear_hive(self, request):
+        try:
+            version = await clear_hive_instructions(self.expected_version(request.query.get("version")))
+        except HiveConflict as e:
+            return web.json_response({"error": "version conflict", "version": e.version}, status=409)
+        hive_log.info("🧹 Global instructions cleared via control API.")
+        return web.json_response({"version": version, "instructions": []})
+
+    async def broadcast(self, request):
+        data = await self.read_json(request)
+        text = str(data.get("text") or "").strip()
+        if not text:
+            return web.json_response({"error": "text is required"}, status=400)
+        self.broadcast_count += 1
+        progress = {"id": self.broadcast_count, "text": text, "state": "queued", "total": None, "done": 0, "failed": 0}
+        self.broadcasts.append(progress)
+        task = asyncio.create_task(self.run_broadcast(progress))
+        self.broadcast_tasks.add(task)
+        task.add_done_callback(self.broadcast_tasks.discard)
+        return web.json_response({"queued": True, "id": progress["id"], "shared": settings_store.shared}, status=202)
+
+    async def run_broadcast(self, progress):
+        async with self.broadcast_lock:
+            progress["state"] = "running"
+            try:
+                await broadcast(progress["text"], progress)
+                progress["state"] = "done"
+            except Exception as e:
+                progress["state"] = "error"
+                hive_log.error(f"Broadcast {progress['id']} failed: {e}")
+
+    async def status(self, request):
+        return web.json_response({
+            "user": str(client.user) if client.user else None,
+            "shards": sorted(client.shards) if SHARDING else None,
+            "enabled_channels": len(settings_store.enabled_ids),
+            "hive_version": hive_version,
+            "hive_instructions": len(hive_mind_instructions),
+            "api_inflight": api_client.inflight,
+            "reply_queue_depth": reply_scheduler.pending_count,
+            "reply_active": len(reply_scheduler.active),
+            "errors_today": uptime_metrics.errors_today(),
+            "loop_lag_ms": round(loop_lag.lag * 1000, 1),
+            "backends": {name: backend.breaker.state for name, backend in BACKENDS.items()},
+            "rate_limited": rate_limiter.rejected,
+            "lean_client": LEAN_CLIENT,
+            "gateway_dropped": gateway_dropped,
+            "startup_seconds": client.startup_seconds,
+            "rss_mb": rss_mb(),
+            "broadcasts": list(self.broadcasts)
+        })
+
+    async def metrics(self, request):
+        return web.Response(text=render_prometheus(), content_type="text/plain", charset="utf-8")
+
+control_server = ControlServer(CONTROL_HOST, CONTROL_PORT, CONTROL_SOCKET, CONTROL_TOKEN)
+
+# --- COMMANDS ---
+
+COMMANDS = {} # { "+команда": async handler(message, channel_id) }
+command_stats = {} # { "+команда": [calls, total_seconds, max_seconds] }
+
+def command(name):
+    """Registers a chat command handler under its exact (lowercase) text."""
+    def decorator(func):
+        COMMANDS[name] = func
+        return func
+    return decorator
+
+async def run_command(name, message):
+    handler = COMMANDS[name]
+    started = time.perf_counter()
+    try:
+        await handler(message, message.channel.id)
+    finally:
+        elapsed = time.perf_counter() - started
+        stats = command_stats.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+
+@command('+переключить')
+async def cmd_toggle(message, cid):
     settings = get_settings(cid)
+    settings["enabled"] = not settings["enabled"]
+    save_settings(cid)
 
-    # --- COMMANDS ---
-    # Strict check: If message starts with '+' but is not a known command, ignore it.
-    # --- COMMANDS ---
-    # Strict check
-    if msg.startswith('+'):
-        known_commands = [
-            '+переключить', '+настройки', '+аптайм', '+хелп', '+статус', '+админ-панель', '+модели', '+очистить историю'
+    status = "✅ Онлайн" if settings["enabled"] else "🔴 Офлайн"
+    color = discord.Color.green() if settings["enabled"] else discord.Color.red()
+
+    await message.channel.send(embed=discord.Embed(title=f"Состояние: {status}", color=color))
+
+@command('+очистить историю')
+async def cmd_clear_history(message, cid):
+    conversation_history.clear(cid)
+    rolling_summarizer.forget(cid)
+    await message.channel.send("🧹 История очищена.")
+
+@command('+пинг')
+async def cmd_ping(message, cid):
+    await message.channel.send(f"🏓 Понг! {round(client.latency * 1000)}мс")
+
+@command('+настройки')
+async def cmd_settings(message, cid):
+    view = SettingsView(cid)
+    await message.channel.send(embed=view.get_embed(), view=view)
+
+@command('+аптайм')
+async def cmd_uptime(message, cid):
+    now = uptime_metrics.now()
+
+    # Show last 30 days
+    days_to_show = 30
+    squares = []
+
+    for ok, count, _ in uptime_metrics.rings["day"].series(now, days_to_show):
+        if count <= 7:
+            squares.append("🟩") # Stable/Excellent (0-7 errors)
+        elif count <= 20:
+            squares.append("🟨") # Unstable (8-20 errors)
+        elif count <= 40:
+            squares.append("🟧") # High Error Rate (21-40 errors)
+        else:
+            squares.append("🟥") # Critical (40+ errors)
+
+    history_str = "".join(squares)
+    rows = [history_str[i:i+10] for i in range(0, len(history_str), 10)]
+    history_str = "\n".join(rows)
+
+    # Error rate heatmap for the last 24 hours
+    hours = uptime_metrics.rings["hour"].series(now, 24)
+    heat = []
+    for ok, err, _ in hours:
+        total = ok + err
+        rate = err / total if total else 0
+        if not total:
+            heat.append("⬛") # No requests
+        elif rate < 0.01:
+            heat.append("🟩")
+        elif rate < 0.05:
+            heat.append("🟨")
+        elif rate < 0.2:
+            heat.append("🟧")
+        else:
+            heat.append("🟥")
+    heat_str = "".join(heat[:12]) + "\n" + "".join(heat[12:])
+
+    total_ok = sum(h[0] for h in hours)
+    total_err = sum(h[1] for h in hours)
+    latency_sum = sum(h[2] for h in hours)
+    total = total_ok + total_err
+    success_str = f"{total_ok / total * 100:.1f}%" if total else "—"
+    latency_str = f"{latency_sum / total:.2f}с" if total else "—"
+
+    embed = discord.Embed(title="Аптайм (Время безотказной работы ИИ)", color=discord.Color.green())
+    embed.description = (
+        f"Последние {days_to_show} дней:\n\n{history_str}\n\n🟩 Стабильно (0-7 ошибок)\n🟨 Нестабильно (8-20 ошибок)\n🟧 Сбои (21-40 ошибок)\n🟥 Критично (40+ ошибок)\n\n"
+        f"Последние 24 часа (доля ошибок по часам):\n\n{heat_str}\n\n⬛ Нет запросов 🟩 <1% 🟨 <5% 🟧 <20% 🟥 20%+\n"
+        f"Успешных запросов: {success_str} из {total}, средняя задержка: {latency_str}"
+    )
+    await message.channel.send(embed=embed)
+
+@command('+хелп')
+async def cmd_help(message, cid):
+    desc = (
+        "🌌 **Mirra AI — Ваш ультимативный Хаб Агентов**\n\n"
+        "Зачем ограничиваться одной моделью, когда можно собрать совет директоров из нейросетей?\n\n"
+        "🤖 **Арсенал Агентов:**\n"
+        "⚡ **Mistral Large**: Наш основной двигатель. Быстрый, точный, идеален для повседневного кода.\n"
+        "🧠 **Claude Opus 4.5**: Агент с глубоким тактическим мышлением для сложных архитектурных споров.\n"
+        "🔮 **GPT-5.2 Codex**: Футуристический агент, заточенный под генерацию системных решений.\n"
+        "🌐 **Gemini 3 Pro**: Специалист по креативным и нестандартным задачам.\n"
+        "💀 **ssbaxys-realtime-1**: Собственная разработка уникального ИИ без цензуры.\n"
+        "*(Переключение между агентами — через `+модели`)*\n\n"
+        "🛠 **Командный центр:**\n"
+        "`+настройки` — ⚙️ **Панель управления**. Доступ к функциям DeepWork, Real-time Reading и другим модулям.\n"
+        "`+переключить` — ⏯️ **Вкл/Выкл**. Активация или деактивация бота в текущем канале.\n"
+        "`+очистить историю` — 🧹 **Сброс логов**. Начните обсуждение с чистого листа.\n"
+        "`+аптайм` — 📈 **Мониторинг**. История стабильности серверов.\n"
+        "`+хелп` — 📜 **Справка**.\n\n"
+        "**Mirra AI — код начинается здесь.**"
+    )
+    embed = discord.Embed(description=desc, color=discord.Color.from_rgb(44, 47, 51))
+    await message.channel.send(embed=embed)
+
+@command('+статус')
+async def cmd_status(message, cid):
+    settings = get_settings(cid)
+    age = health_prober.age()
+    if age is None:
+        api_status = "⏳ Проверяется"
+    else:
+        api_status = "✅ Онлайн" if health_prober.last_ok else "❌ Недоступен"
+        api_status += f"\n{health_prober.last_latency * 1000:.0f}мс, {age:.0f}с назад"
+        api_status += f"\nОшибки: {health_prober.error_rate() * 100:.0f}% из {len(health_prober.results)}"
+
+    embed = discord.Embed(title="📊 Статус Системы", color=discord.Color.blue())
+    embed.add_field(name="Менеджер", value=f"Antigravity v2.0", inline=True)
+    embed.add_field(name="API Mistral", value=api_status, inline=True)
+    breaker_lines = []
+    for backend in BACKENDS.values():
+        breaker = backend.breaker
+        if breaker.state == CircuitBreaker.CLOSED:
+            state = f"🟢 замкнут ({breaker.failures} ошибок подряд)"
+        elif breaker.blocked() and breaker.state == CircuitBreaker.OPEN:
+            state = f"🔴 разомкнут, проба через {breaker.retry_in():.0f}с"
+        else:
+            state = "🟡 полуоткрыт, идет пробный запрос" if breaker.probing else "🟡 полуоткрыт, ждет пробного запроса"
+        breaker_lines.append(f"`{backend.name}` — {state}, срабатываний: {breaker.trips}")
+    breaker_lines.append(f"Бюджет повторов: {retry_budget.tokens:.1f}/{retry_budget.reserve} (потрачено {retry_budget.spent}, отказано {retry_budget.denied})")
+    embed.add_field(name="Предохранитель", value="\n".join(breaker_lines), inline=False)
+    embed.add_field(name="Текущий чат", value="✅ Включен" if settings["enabled"] else "❌ Отключен", inline=False)
+    embed.add_field(name="Модель", value=settings["model"], inline=False)
+    if response_cache.enabled:
+        cache_value = f"{response_cache.hits} попаданий / {response_cache.misses} промахов, записей: {len(response_cache.entries)}"
+    else:
+        cache_value = "Выключен"
+    embed.add_field(name="Кэш ответов", value=cache_value, inline=False)
+    limits = rate_limits()
+    embed.add_field(
+        name="Лимиты сообщений",
+        value=" · ".join(f"{AdminButton.RATE_LABELS[scope]}: {format_rate_limit(limits[scope])}" for scope in RATE_SCOPES)
+              + f"\nПропущено {rate_limiter.admitted}, отклонено {rate_limiter.rejected}",
+        inline=False
+    )
+    if command_stats:
+        lines = [
+            f"`{name}` — {calls} раз, ср. {total / calls * 1000:.0f}мс, макс. {worst * 1000:.0f}мс"
+            for name, (calls, total, worst) in sorted(command_stats.items(), key=lambda item: -item[1][0])
         ]
-        # Check against known commands (handling simple typos or partially correct commands is out of scope for now)
-        if msg not in known_commands:
-            return
+        embed.add_field(name="Команды", value="\n".join(lines[:10]), inline=False)
+    await message.channel.send(embed=embed)
 
-    if msg == '+переключить':
-        settings["enabled"] = not settings["enabled"]
-        save_settings()
-        
-        status = "✅ Онлайн" if settings["enabled"] else "🔴 Офлайн"
-        color = discord.Color.green() if settings["enabled"] else discord.Color.red()
-        
-        await message.channel.send(embed=discord.Embed(title=f"Состояние: {status}", color=color))
+@command('+медленные')
+async def cmd_slow_stages(message, cid):
+    slowest = tracer.slowest(10)
+    if not slowest:
+        await message.channel.send("📭 Замеров пока нет.")
         return
+    lines = [
+        f"`{stage}` — p95 ≤ {h.quantile(0.95) * 1000:.0f}мс, ср. {h.sum / h.count * 1000:.1f}мс, макс. {h.max * 1000:.0f}мс, {h.count} раз"
+        for stage, h in slowest
+    ]
+    embed = discord.Embed(title="🐢 Самые медленные этапы", description="\n".join(lines), color=discord.Color.orange())
+    embed.set_footer(text=f"Задержка цикла событий: {loop_lag.lag * 1000:.1f}мс, запросов к API: {api_client.inflight}, в очереди: {reply_scheduler.pending_count}")
+    await message.channel.send(embed=embed)
 
-    if msg == '+очистить историю':
-        conversation_history[cid] = []
-        await message.channel.send("🧹 История очищена.")
-        return
+@command('+модели')
+async def cmd_models(message, cid):
+    settings = get_settings(cid)
+    await message.channel.send(
+        embed=discord.Embed(title="🧠 Выбор модели", description=f"Сейчас: {settings['model']}", color=discord.Color.gold()), 
+        view=ModelView(cid)
+    )
 
-    if msg == '+пинг':
-        await message.channel.send(f"🏓 Понг! {round(client.latency * 1000)}мс")
-        return
+@command('+админ-панель')
+async def cmd_admin_panel(message, cid):
+    embed = discord.Embed(
+        title="🛠 Админ-панель",
+        description="Управление доступом к моделям и лимитами сообщений.",
+        color=discord.Color.dark_red()
+    )
+    await message.channel.send(embed=embed, view=AdminPanelView(cid))
 
-    if msg == '+настройки':
-        view = SettingsView(cid)
-        await message.channel.send(embed=view.get_embed(), view=view)
-        return
+# --- EVENTS ---
 
-    if msg == '+аптайм':
-        error_log = global_settings.get("error_log", {})
-        
-        # Show last 30 days
-        days_to_show = 30
-        today = datetime.now()
-        
-        squares = []
-        
-        for i in range(days_to_show - 1, -1, -1):
-            date = (today - timedelta(days=i)).strftime("%Y-%m-%d")
-            count = error_log.get(date, 0)
-            
-            if count <= 7:
-                squares.append("🟩") # Stable/Excellent (0-7 errors)
-            elif count <= 20:
-                squares.append("🟨") # Unstable (8-20 errors)
-            elif count <= 40:
-                squares.append("🟧") # High Error Rate (21-40 errors)
-            else:
-                squares.append("🟥") # Critical (40+ errors)
-        
-        history_str = "".join(squares)
-        rows = [history_str[i:i+10] for i in range(0, len(history_str), 10)]
-        history_str = "\n".join(rows)
-        
-        embed = discord.Embed(title="Аптайм (Время безотказной работы ИИ)", color=discord.Color.green())
-        embed.description = f"Последние {days_to_show} дней:\n\n{history_str}\n\n🟩 Стабильно (0-7 ошибок)\n🟨 Нестабильно (8-20 ошибок)\n🟧 Сбои (21-40 ошибок)\n🟥 Критично (40+ ошибок)"
-        await message.channel.send(embed=embed)
-        return
+@client.event
+async def on_ready():
+    # Fires again after every gateway reconnect: nothing here may reload or reset state
+    log.info(f'Logged in as {client.user}')
+    if client.startup_seconds is None:
+        client.startup_seconds = time.perf_counter() - PROCESS_STARTED
+        rss = rss_mb()
+        log.info(f"Startup: {client.startup_seconds:.1f}s to ready, RSS {f'{rss:.0f}MB' if rss else 'n/a'}, "
+                 f"{len(client.guilds)} guilds ({'lean' if LEAN_CLIENT else 'default'} client)")
+    if SHARDING:
+        log.info(f"Shards in this process: {sorted(client.shards)} of {client.shard_count}")
+    log.info('Bot is ready!')
 
-    if msg == '+хелп':
-        desc = (
-            "🌌 **Mirra AI — Ваш ультимативный Хаб Агентов**\n\n"
-            "Зачем ограничиваться одной моделью, когда можно собрать совет директоров из нейросетей?\n\n"
-            "🤖 **Арсенал Агентов:**\n"
-            "⚡ **Mistral Large**: Наш основной двигатель. Быстрый, точный, идеален для повседневного кода.\n"
-            "🧠 **Claude Opus 4.5**: Агент с глубоким тактическим мышлением для сложных архитектурных споров.\n"
-            "🔮 **GPT-5.2 Codex**: Футуристический агент, заточенный под генерацию системных решений.\n"
-            "🌐 **Gemini 3 Pro**: Специалист по креативным и нестандартным задачам.\n"
-            "💀 **ssbaxys-realtime-1**: Собственная разработка уникального ИИ без цензуры.\n"
-            "*(Переключение между агентами — через `+модели`)*\n\n"
-            "🛠 **Командный центр:**\n"
-            "`+настройки` — ⚙️ **Панель управления**. Доступ к функциям DeepWork, Real-time Reading и другим модулям.\n"
-            "`+переключить` — ⏯️ **Вкл/Выкл**. Активация или деактивация бота в текущем канале.\n"
-            "`+очистить историю` — 🧹 **Сброс логов**. Начните обсуждение с чистого листа.\n"
-            "`+аптайм` — 📈 **Мониторинг**. История стабильности серверов.\n"
-            "`+хелп` — 📜 **Справка**.\n\n"
-            "**Mirra AI — код начинается здесь.**"
-        )
-        embed = discord.Embed(description=desc, color=discord.Color.from_rgb(44, 47, 51))
-        await message.channel.send(embed=embed)
-        return
+@client.event
+async def on_message(message):
+    # Check if this is a bot message to stop any typing status
+    if message.author.bot:
+        typing_wheel.cancel(message.channel.id)
+        if message.author == client.user:
+            return
 
-    if msg == '+статус':
-        api_status = "✅ Онлайн"
-        try:
-            requests.get("https://api.mistral.ai", timeout=5)
-        except:
-            api_status = "❌ Недоступен"
-        
-        embed = discord.Embed(title="📊 Статус Системы", color=discord.Color.blue())
-        embed.add_field(name="Менеджер", value=f"Antigravity v2.0", inline=True)
-        embed.add_field(name="API Mistral", value=api_status, inline=True)
-        embed.add_field(name="Текущий чат", value="✅ Включен" if settings["enabled"] else "❌ Отключен", inline=False)
-        embed.add_field(name="Модель", value=settings["model"], inline=False)
-        await message.channel.send(embed=embed)
-        return
+    cid = message.channel.id
+    content = message.content.lstrip()
 
-    if msg == '+модели':
-        await message.channel.send(
-            embed=discord.Embed(title="🧠 Выбор модели", description=f"Сейчас: {settings['model']}", color=discord.Color.gold()), 
-            view=ModelView(settings['model'])
-        )
+    # --- COMMANDS ---
+    # Strict check: If message starts with '+' but is not a known command, ignore it.
+    if content.startswith('+'):
+        msg = content.rstrip().lower()
+        if msg in COMMANDS:
+            await run_command(msg, message)
         return
 
-    if msg == '+админ-панель':
-        embed = discord.Embed(
-            title="🛠 Админ-панель",
-            description="Управление доступом к моделям.",
-            color=discord.Color.dark_red()
-        )
-        await message.channel.send(embed=embed, view=AdminPanelView())
+    # Everything else only matters in enabled channels. Checked before any
+    # settings lookup, so ignored traffic allocates nothing and never touches disk.
+    if cid not in settings_store.enabled_ids:
         return
+    with tracer.span("settings_lookup"):
+        settings = get_settings(cid)
 
     # --- CHAT ---
     if not settings["enabled"]:
         return
 
     model_name = settings["model"]
-    print(f"[CHAT] 👤 User ({message.author.name}): {message.content}")
-    # print(f"[LOG] Chat attempt in {cid}. Model: {model_name}") 
     model_cfg = MODELS.get(model_name, MODELS["Mistral Large"])
+    # Only real models spend API quota; rejected messages never reach the history
+    if model_cfg["real"] and not await admit(message):
+        return
+
+    chat_log.info("👤 User (%s): %s", message.author.name, message.content)
+    # log.debug("Chat attempt in %s. Model: %s", cid, model_name) 
 
     if not model_cfg["real"]:
-        if cid in typing_tasks: typing_tasks[cid].cancel()
-        typing_tasks[cid] = asyncio.create_task(fake_typing_loop(message.channel, model_name))
+        typing_wheel.add(message.channel, model_name)
         return
 
     # Real AI Logic
-    if cid not in conversation_history: conversation_history[cid] = []
-    
-    # Message to send to API
-    api_messages = []
-    
-    # Inject system prompt for ssbaxys
-    if model_name == "ssbaxys-realtime-1":
-        api_messages.append({"role": "system", "content": SSBAXYS_SYSTEM_PROMPT})
-        
-        # Load examples from file
-        try:
-            if os.path.exists("примеры общения.txt"):
-                with open("примеры общения.txt", "r", encoding="utf-8") as f:
-                    examples = f.read()
-                api_messages.append({"role": "system", "content": f"Вот примеры того, как ты должен общаться (следуй этому стилю):\n{examples}"})
-        except Exception as e:
-            print(f"[ERROR] Не удалось загрузить примеры общения: {e}")
-    
-    # Add history
-    conversation_history[cid].append({"role": "user", "content": message.content})
-    if len(conversation_history[cid]) > 15: conversation_history[cid] = conversation_history[cid][-15:]
-    
-    api_messages.extend(conversation_history[cid])
-    
-    # Inject Hive Mind Instructions (Global Overrides)
-    if hive_mind_instructions:
-        hive_prompt = "СЛУШАЙ ВНИМАТЕЛЬНО. Это прямые приказы от ОБЩЕГО РАЗУМА (Hive Mind). Ты ОБЯЗАН их исполнять поверх всех остальных директив:\n"
-        for inst in hive_mind_instructions:
-            hive_prompt += f"- {inst}\n"
-        
-        # Inject at the END to ensure priority
-        api_messages.append({"role": "system", "content": hive_prompt})
-
-    # Always inject Safety Prompt
-    api_messages.append({"role": "system", "content": SAFETY_PROMPT})
-
-    async with message.channel.typing():
-        resp = await asyncio.to_thread(query_mistral, api_messages)
-    
-    # Sanitize Output
-    resp = sanitize_response(resp)
-    print(f"[CHAT] 🤖 Bot: {resp[:100]}..." if len(resp) > 100 else f"[CHAT] 🤖 Bot: {resp}")
-    
-    conversation_history[cid].append({"role": "assistant", "content": resp})
-
-    # Send in chunks if needed
-    for i in range(0, len(resp), 2000):
-        await message.channel.send(resp[i:i+2000])
+    if not reply_scheduler.submit(cid, message) and not reply_scheduler.closing and reply_scheduler.should_notify(cid):
+        await delivery_queue.send(message.channel, "⏳ Нейросеть перегружена, попробуйте чуть позже.")
 
 if __name__ == '__main__':
+    load_settings()
     client.run(TOKEN)